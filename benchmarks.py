@@ -0,0 +1,226 @@
+from __future__ import print_function
+
+import gc, sys, time, types
+import numpy as np
+
+from hdf5storage import Storage, blocks
+
+#################### HELPERS ###################################################
+
+#
+# Estimate the memory held by an object graph, counting shared objects once
+def deep_sizeof(obj):
+	seen = set()
+	stack = [obj]
+	total = 0
+	while len(stack) > 0:
+		o = stack.pop()
+		if id(o) in seen or isinstance(o,(type,types.ModuleType,types.FunctionType)):
+			continue
+		seen.add(id(o))
+		total += sys.getsizeof(o)
+		stack.extend(gc.get_referents(o))
+	return total
+
+def timed(f,*args,**kwargs):
+	start = time.time()
+	result = f(*args,**kwargs)
+	return time.time()-start, result
+
+#################### BENCHMARKS ################################################
+
+#
+# Time to import the package and build a Storage in memory, in a fresh
+# interpreter, and which of the HDF5 libraries that imports; then the time of
+# the first save, which imports the backend
+def bench_import(repeats=5):
+	import subprocess
+	script = "; ".join([
+		"import sys, time",
+		"start = time.time()",
+		"import hdf5storage",
+		"imported = time.time()",
+		"d = hdf5storage.Storage('bench'); d['x'] = [1,2,3]",
+		"built = time.time()",
+		"heavy = sorted(set(m.split('.')[0] for m in sys.modules) & set(['tables','h5py','scipy','multiprocessing']))",
+		"d.save(sys.argv[1])",
+		"print('%f %f %f %s' % (imported-start,built-imported,time.time()-built,','.join(heavy) or '-'))",
+	])
+	runs = [subprocess.check_output([sys.executable,'-W','ignore','-c',script,'bench_import.hdf5']).decode().split() for i in range(repeats)]
+	imported,built,saved = [min(float(run[i]) for run in runs) for i in range(3)]
+	print("import: import %.3fs, build %.3fs (modules loaded: %s); first save %.3fs" % (imported,built,runs[0][3],saved))
+
+#
+# Memory used per leaf node for a DataList expanded into many small leaves
+def bench_node_memory(n=100000):
+	d = Storage('bench')
+	values = list(range(n))
+	duration,_ = timed(d.__setitem__,'values',values)
+	node = d.node('values')
+	total = deep_sizeof(node) - deep_sizeof(values)
+	print("node_memory: %d leaves built in %.3fs; %.1f bytes per leaf" % (n,duration,float(total)/n))
+
+#
+# Inserting many keys one at a time versus through a single bulk update
+def bench_bulk_update(n=100000,groups=100):
+	data = dict(("g%d/k%d"%(i%groups,i),float(i)) for i in range(n))
+	
+	d = Storage('bench',attrs={'auto_nodes':True})
+	def loop():
+		for key,value in data.items():
+			group,name = key.split('/')
+			d.node(group)[name] = value
+	looped,_ = timed(loop)
+	
+	d = Storage('bench',attrs={'auto_nodes':True})
+	bulk,_ = timed(d.update,data)
+	print("bulk_update: %d keys in %d groups; __setitem__ %.3fs, update %.3fs" % (n,groups,looped,bulk))
+
+#
+# Saving and loading a large lookup table stored as a single DataDict
+def bench_dict_table(n=100000,location='bench_dict.hdf5'):
+	d = Storage('bench')
+	d['table'] = dict(("key%d"%i,float(i)) for i in range(n))
+	write,_ = timed(d.__rshift__,location)
+	read,_ = timed(Storage._load,location)
+	print("dict_table: %d entries; write %.3fs, load %.3fs" % (n,write,read))
+
+#
+# Compare the storage backends on a few large arrays, and on many small leaves
+def bench_backends(arrays=10,size=2000000,leaves=5000,location='bench_backends.hdf5'):
+	large = Storage('bench')
+	for i in range(arrays):
+		large['a%d'%i] = np.random.random(size)
+	small = Storage('bench')
+	small.update(("l%d"%i,np.arange(10)) for i in range(leaves))
+	
+	for backend in ['pytables','h5py']:
+		for name,d in [('large',large),('small',small)]:
+			write,_ = timed(d.save,location,backend=backend)
+			read,_ = timed(Storage._load,location,backend=backend)
+			print("backends: %-8s %-5s write %.3fs, load %.3fs" % (backend,name,write,read))
+
+#
+# Loading eagerly versus lazily, and first versus repeated access to lazy leaves
+def bench_lazy_cache(arrays=200,size=100000,location='bench_lazy.hdf5'):
+	from hdf5storage.cache import LeafCache
+	d = Storage('bench')
+	for i in range(arrays):
+		d['a%d'%i] = np.random.random(size)
+	d.save(location)
+	
+	eager,_ = timed(Storage._load,location)
+	cache = LeafCache(max_bytes=arrays*size*8//4)
+	lazy,d = timed(Storage._load,location,lazy=True,cache=cache)
+	def access():
+		for i in range(arrays):
+			d['a%d'%(i%(arrays//8))]
+	first,_ = timed(access)
+	repeat,_ = timed(access)
+	print("lazy_cache: %d arrays; load eager %.3fs, lazy %.3fs; access %.3fs, repeated %.3fs; %r" % (arrays,eager,lazy,first,repeat,cache))
+	d.close()
+
+#
+# Saving a tree to a single file, and sharded across files (serially and in
+# parallel)
+def bench_shards(groups=8,arrays=20,size=200000,processes=4,location='bench_shards.hdf5'):
+	d = Storage('bench')
+	for i in range(groups):
+		group = d.node('g%d'%i,create=True)
+		for j in range(arrays):
+			group['a%d'%j] = np.random.random(size)
+	
+	single,_ = timed(d.save,location)
+	serial,_ = timed(d.save_shards,location)
+	parallel,_ = timed(d.save_shards,location,processes=processes)
+	read,_ = timed(Storage._load,location)
+	print("shards: %d groups; single file %.3fs, sharded %.3fs, sharded with %d processes %.3fs; load %.3fs" % (groups,single,serial,processes,parallel,read))
+
+#
+# Writing and opening a single group with very many children
+def bench_wide_group(n=20000,location='bench_wide.hdf5'):
+	d = Storage('bench')
+	d.update(("l%d"%i,np.arange(4)) for i in range(n))
+	for backend in ['pytables','h5py']:
+		write,_ = timed(d.save,location,backend=backend)
+		opened,d2 = timed(Storage._load,location,backend=backend,lazy=True)
+		d2.close()
+		print("wide_group: %-8s %d children; write %.3fs, open %.3fs" % (backend,n,write,opened))
+
+#
+# Size, write and read times, and codec selection overhead, with and without
+# automatic compression, for a mix of (in)compressible arrays
+def bench_compression(size=2000000,location='bench_compression.hdf5'):
+	import os
+	from hdf5storage.compression import CompressionPolicy
+	d = Storage('bench')
+	d['noise'] = np.random.random(size)
+	d['smooth'] = np.sin(np.linspace(0,100,size))
+	d['counts'] = np.random.poisson(3,size)
+	d['sparse'] = np.where(np.random.random(size) < 0.01,1.0,0.0)
+	
+	for goal in [None,'ratio','speed']:
+		compression = CompressionPolicy(goal,record_time=True) if goal is not None else None
+		write,_ = timed(d.save,location,compression=compression)
+		read,d2 = timed(Storage._load,location)
+		selection = sum(d2.node_attrs(leaf).get('hdf5storage_compression_time',0) for leaf in d2)
+		print("compression: %-5s %.1fMB; write %.3fs (of which selection %.3fs), read %.3fs" % (goal,os.path.getsize(location)/1e6,write,selection,read))
+
+#
+# Time and peak memory of blockwise map and reduce over a stored array, against
+# reading the whole array, for increasing numbers of workers
+def bench_blocks(rows=4000000,location='bench_blocks.hdf5'):
+	import resource
+	peak = lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+	
+	# The array is itself written blockwise, so that it is never in memory; its
+	# rows are 16 times the size of the rows they are made from
+	d = Storage('bench')
+	d['seed'] = np.arange(rows)
+	d.save(location)
+	d = Storage._load(location,lazy=True,mode='a')
+	base = peak()
+	d.map_blocks('seed',lambda block: np.random.random((len(block),16)),out='x',block_bytes=blocks.BLOCK_BYTES//16)
+	d.close()
+	for workers in [1,2,4]:
+		d = Storage._load(location,lazy=True,mode='a')
+		map,_ = timed(d.map_blocks,'x',lambda block: np.sqrt(block).sum(axis=1),out='y%d'%workers,workers=workers)
+		reduce,_ = timed(d.reduce_blocks,'x',lambda block: np.sqrt(block).sum(),lambda a,b: a+b,workers=workers)
+		d.close()
+		print("blocks: %d workers, map %.3fs, reduce %.3fs; peak memory +%.0fMB (array %.0fMB)" % (workers,map,reduce,peak()-base,rows*16*8/1024.**2))
+	
+	x = Storage._load(location)['x']
+	whole,_ = timed(lambda: np.sqrt(x).sum(axis=1))
+	print("whole array: %.3fs; peak memory +%.0fMB" % (whole,peak()-base))
+
+#
+# Write overhead of digests, and the time to diff two files and to verify one,
+# against loading and comparing both files in full
+def bench_digests(n=50,size=1000000,location='bench_digests.hdf5',other='bench_digests2.hdf5'):
+	from hdf5storage import diff, verify
+	d = Storage('bench')
+	for i in range(n):
+		d['a%d'%i] = np.random.random(size)
+	
+	plain,_ = timed(d.save,location)
+	leaf,_ = timed(d.save,location,digests=True)
+	chunked,_ = timed(d.save,location,digests='chunks')
+	d['a0'][0] = -1
+	d.save(other,digests='chunks')
+	print("digests: %d arrays of %.0fMB; write %.3fs, with digests %.3fs, with chunk digests %.3fs" % (n,size*8/1e6,plain,leaf,chunked))
+	
+	def compare():
+		a,b = Storage._load(location),Storage._load(other)
+		return [name for name in a.leaves if not np.array_equal(a[name],b[name])]
+	full,_ = timed(compare)
+	diffed,differences = timed(diff,location,other)
+	verified,_ = timed(verify,location)
+	print("digests: diff %.3fs (%s), verify %.3fs; load and compare %.3fs" % (diffed,differences,verified,full))
+
+BENCHMARKS = [bench_import,bench_node_memory,bench_bulk_update,bench_dict_table,bench_backends,bench_lazy_cache,bench_shards,bench_wide_group,bench_compression,bench_blocks,bench_digests]
+
+if __name__ == '__main__':
+	selected = sys.argv[1:]
+	for benchmark in BENCHMARKS:
+		if len(selected) == 0 or benchmark.__name__[len('bench_'):] in selected:
+			benchmark()
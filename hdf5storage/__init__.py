@@ -1,2 +1,3 @@
-from data import Storage
-import errors
+from .data import Storage
+from .digest import diff, verify
+from . import errors
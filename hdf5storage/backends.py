@@ -0,0 +1,654 @@
+import pickle, re, warnings
+from abc import abstractmethod, abstractproperty
+
+import numpy as np
+
+from .utility import Abstract, NUMBER_TYPES, TEXT_TYPES, utf8Array
+from .compression import chunkShape
+from . import errors
+
+###################### STORAGE BACKENDS ########################################
+#
+# A backend is an open HDF5 file, together with the handful of operations that
+# HDF5Node objects need in order to write themselves to, and restore themselves
+# from, that file. Nodes are whatever objects the underlying library uses to
+# represent groups and datasets; they are only ever passed back to the backend
+# that produced them. All backends produce the same file layout, so that a file
+# written with one backend can be read with any other.
+
+#
+# PyTables and h5py take far longer to import than the rest of this package
+# together, and are only needed once a file is opened; so each is imported by
+# the first backend to use it.
+tables = None
+h5py = None
+
+def importTables():
+	global tables
+	if tables is None:
+		import tables as module
+		tables = module
+	return tables
+
+def importH5py():
+	global h5py
+	if h5py is None:
+		try:
+			import h5py as module
+		except ImportError:
+			raise errors.BackendError("The h5py backend requires the h5py package to be installed.")
+		h5py = module
+	return h5py
+
+#
+# h5py returns names as unicode strings under Python 2 (and as bytes from its
+# low-level API under Python 3); nodes and attributes are always named with
+# native strings.
+def nativeString(value):
+	if isinstance(value,str):
+		return value
+	return value.encode('utf-8') if str is bytes else value.decode('utf-8')
+
+# The low-level h5py API takes names as bytes
+def byteString(value):
+	return value if isinstance(value,bytes) else value.encode('utf-8')
+
+#
+# Text attributes are stored as UTF-8 bytes, and returned as native strings
+def nativeAttr(value):
+	if isinstance(value,bytes) and str is not bytes:
+		return value.decode('utf-8')
+	return value
+
+#
+# PyTables pickles attributes other than numpy arrays and scalars (e.g. None,
+# lists and dicts) into a string, and unpickles any string attribute which looks
+# like a pickle (ending in '.'), keeping the string if it does not unpickle; the
+# h5py backend writes and reads them in the same way.
+NATIVE_ATTR_TYPES = (np.ndarray,np.generic,bytes) + NUMBER_TYPES + TEXT_TYPES
+
+def pickleAttr(value):
+	if isinstance(value,NATIVE_ATTR_TYPES) and not (isinstance(value,np.ndarray) and value.dtype.hasobject):
+		return value
+	return pickle.dumps(value,0)
+
+def unpickleAttr(value):
+	if not isinstance(value,bytes) or not value.endswith(b'.') or value in (b'0',b'0.'):
+		return value
+	try:
+		return pickle.loads(value)
+	except UnicodeDecodeError: # Pickled under Python 2
+		try:
+			return pickle.loads(value,encoding='latin1')
+		except Exception:
+			return value
+	except Exception:
+		return value
+
+class Backend(Abstract):
+
+	name = None
+
+	# The `compression.CompressionPolicy` for the arrays written, if any
+	compression = None
+
+	# The `digest.DigestPolicy` for the arrays and tables written, if any
+	digests = None
+
+	@abstractproperty
+	def root(self):
+		pass
+
+	@abstractmethod
+	def close(self):
+		pass
+
+	@abstractproperty
+	def is_open(self):
+		pass
+
+	######## Writing ###########################################################
+
+	#
+	# Nodes are created together with their (user) attributes, `attrs`, so that
+	# backends can write them all at once where their library allows it (see
+	# `set_attrs` of each backend).
+	@abstractmethod
+	def create_group(self,parent,name,title="",attrs=None):
+		pass
+
+	#
+	# `filters`, if given, is the `compression.Choice` of codec and chunk shape
+	# with which to write the array
+	@abstractmethod
+	def create_array(self,parent,name,array,title="",attrs=None,filters=None):
+		pass
+
+	#
+	# Create a table from a numpy structured array; one row per record
+	@abstractmethod
+	def create_table(self,parent,name,entries,title="",attrs=None):
+		pass
+
+	#
+	# Link `name` to the node at `path` in another file. Relative file names are
+	# resolved against the directory of the file holding the link.
+	@abstractmethod
+	def create_external_link(self,parent,name,filename,path="/"):
+		pass
+
+	@abstractmethod
+	def set_attrs(self,node,attrs):
+		pass
+
+	######## Reading ###########################################################
+
+	#
+	# Returns a dictionary of the user (i.e. not library) attributes of `node`
+	@abstractmethod
+	def get_attrs(self,node):
+		pass
+
+	@abstractmethod
+	def get_attr(self,node,name,default=None):
+		pass
+
+	#
+	# Returns a list of (name,node) pairs for the children of a group; external
+	# links are followed, so that linked nodes appear as any other.
+	@abstractmethod
+	def children(self,node):
+		pass
+
+	@abstractmethod
+	def is_group(self,node):
+		pass
+
+	@abstractmethod
+	def read(self,node):
+		pass
+
+	#
+	# Nodes can be looked up again by their path (following external links),
+	# e.g. once the file has released the node objects themselves
+	@abstractmethod
+	def get_node(self,path):
+		pass
+
+	@abstractmethod
+	def has_node(self,path):
+		pass
+
+	#
+	# Remove the node at `path`, together with any nodes beneath it
+	@abstractmethod
+	def remove_node(self,path):
+		pass
+
+	######## Live access #######################################################
+	#
+	# Files opened with `swmr=True` may be read while a single writer appends
+	# to them (HDF5's single-writer/multiple-reader mode). Writers first write
+	# the whole tree, with arrays extendable along their first axis, and then
+	# call `start_swmr`; after which no nodes or attributes may be added, but
+	# arrays may be appended to. Readers call `refresh` to see appended data.
+
+	def start_swmr(self):
+		raise errors.BackendError("The %s backend does not support SWMR access." % self.name)
+
+	def append(self,node,values):
+		raise errors.BackendError("The %s backend does not support SWMR access." % self.name)
+
+	#
+	# Returns the shape of `node`, after bringing it up to date with the file
+	def refresh(self,node):
+		raise errors.BackendError("The %s backend does not support SWMR access." % self.name)
+
+	def flush(self):
+		pass
+
+	######## Blockwise access ##################################################
+	#
+	# Arrays too large for memory are read and written a block of rows (along
+	# their first axis) at a time; see `blocks`.
+
+	#
+	# Returns the chunk shape of an array, or None if it is not chunked
+	@abstractmethod
+	def chunks(self,node):
+		pass
+
+	@abstractmethod
+	def read_rows(self,node,start,stop):
+		pass
+
+	#
+	# Create an array of the given shape and dtype, to be filled by `write_rows`
+	@abstractmethod
+	def create_empty_array(self,parent,name,shape,dtype,chunks,title="",attrs=None):
+		pass
+
+	@abstractmethod
+	def write_rows(self,node,start,values):
+		pass
+
+class PyTablesBackend(Backend):
+
+	name = 'pytables'
+
+	# Nodes are written once and then released, so a large node cache only adds
+	# to the cost of creating them (20000 leaves in one group: 64 slots 5.5s,
+	# 1024 slots 11.2s, 16 slots 4.9s).
+	NODE_CACHE_SLOTS = 16
+
+	def __init__(self,location,mode='r',title="",swmr=False):
+		if swmr:
+			raise errors.BackendError("The %s backend does not support SWMR access." % self.name)
+		importTables()
+		# PyTables 3 takes its parameters in lower case, and PyTables 2 in upper
+		if hasattr(tables,'open_file'):
+			self.h5file = tables.open_file(location,mode=mode,title=title,node_cache_slots=self.NODE_CACHE_SLOTS)
+		else:
+			self.h5file = tables.openFile(location,mode=mode,title=title,NODE_CACHE_SLOTS=self.NODE_CACHE_SLOTS)
+		self.mode = mode
+		self.__external = []
+
+	#
+	# PyTables 3 renamed its camelCase methods; use whichever is available
+	@staticmethod
+	def __compat(obj,name,legacy_name):
+		method = getattr(obj,name,None)
+		return method if method is not None else getattr(obj,legacy_name)
+
+	#
+	# Create a node with the named method of the file. PyTables warns of every
+	# node whose name is not a Python identifier, as no encoded number is (see
+	# `utility.encodeNumbers`); those warnings are silenced here, rather than
+	# for the whole process.
+	def __create(self,name,legacy_name,*args,**kwargs):
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore',tables.NaturalNameWarning)
+			return self.__compat(self.h5file,name,legacy_name)(*args,**kwargs)
+
+	@property
+	def root(self):
+		return self.h5file.root
+
+	def close(self):
+		for h5file in self.__external:
+			if h5file.isopen:
+				h5file.close()
+		self.h5file.close()
+
+	@property
+	def is_open(self):
+		return bool(self.h5file.isopen)
+
+	def create_group(self,parent,name,title="",attrs=None):
+		group = self.__create('create_group','createGroup',parent,name,title)
+		self.set_attrs(group,attrs or {})
+		return group
+
+	def create_array(self,parent,name,array,title="",attrs=None,filters=None):
+		array = utf8Array(array)
+		if filters is None:
+			node = self.__create('create_array','createArray',parent,name,array,title)
+		else:
+			node = self.__create('create_carray','createCArray',parent,name,tables.Atom.from_dtype(array.dtype),array.shape,
+					title=title,filters=tables.Filters(complevel=filters.level,complib='zlib',shuffle=filters.shuffle),chunkshape=filters.chunks)
+			node[...] = array
+		self.set_attrs(node,attrs or {})
+		return node
+
+	# Tables are flushed when the file is closed
+	def create_table(self,parent,name,entries,title="",attrs=None):
+		table = self.__create('create_table','createTable',parent,name,entries.dtype,title,expectedrows=max(len(entries),1))
+		table.append(entries)
+		self.set_attrs(table,attrs or {})
+		return table
+
+	def create_external_link(self,parent,name,filename,path="/"):
+		return self.__create('create_external_link','createExternalLink',parent,name,"%s:%s"%(filename,path))
+
+	#
+	# PyTables has no way to write several attributes at once, so they are
+	# written one at a time (unlike with `H5pyBackend.set_attrs`).
+	def set_attrs(self,node,attrs):
+		for attribute,value in attrs.items():
+			setattr(node._v_attrs,attribute,value)
+
+	def get_attrs(self,node):
+		args = {}
+		for attr in node._v_attrs._f_list():
+			args[attr] = nativeAttr(getattr(node._v_attrs,attr))
+		return args
+
+	def get_attr(self,node,name,default=None):
+		return nativeAttr(getattr(node._v_attrs,name,default))
+
+	def children(self,node):
+		return [(name,self.__follow(child)) for name,child in node._v_children.items()]
+
+	#
+	# PyTables opens the target file of an external link when it is called;
+	# those files are closed along with this one.
+	def __follow(self,node):
+		if not isinstance(node,tables.link.ExternalLink):
+			return node
+		target = node()
+		if target._v_file not in self.__external:
+			self.__external.append(target._v_file)
+		return target
+
+	def is_group(self,node):
+		return isinstance(node,tables.Group)
+
+	def read(self,node):
+		return node.read()
+
+	def flush(self):
+		self.h5file.flush()
+
+	def get_node(self,path):
+		node = self.h5file.root
+		for name in path.split('/'):
+			if name != "":
+				node = self.__follow(self.__compat(node,'_f_get_child','_f_getChild')(name))
+		return node
+
+	def has_node(self,path):
+		return path in self.h5file
+
+	def remove_node(self,path):
+		self.__compat(self.h5file,'remove_node','removeNode')(path,recursive=True)
+
+	def chunks(self,node):
+		return node.chunkshape
+
+	def read_rows(self,node,start,stop):
+		return node[start:stop]
+
+	def create_empty_array(self,parent,name,shape,dtype,chunks,title="",attrs=None):
+		node = self.__create('create_carray','createCArray',parent,name,tables.Atom.from_dtype(np.dtype(dtype)),shape,title=title,chunkshape=chunks)
+		self.set_attrs(node,attrs or {})
+		return node
+
+	def write_rows(self,node,start,values):
+		node[start:start+len(values)] = values
+
+class H5pyBackend(Backend):
+
+	name = 'h5py'
+
+	# PyTables stores booleans as 8-bit bitfields, for which h5py has neither a
+	# predefined type nor a numpy equivalent. This is H5T_STD_B8LE, as serialised
+	# by H5Tencode.
+	BOOL_TYPE = None
+	BOOL_TYPE_ENCODED = b'\x03\x00\x14\x00\x00\x00\x01\x00\x00\x00\x00\x00\x08\x00'
+
+	# Attributes that PyTables reserves for its own use (see `tables.attributeset`)
+	SYSTEM_ATTRS = re.compile("^(CLASS|VERSION|TITLE|NROWS|EXTDIM|ENCODING|PYTABLES_FORMAT_VERSION|FLAVOR|FILTERS|AUTO_INDEX|DIRTY|NODE_TYPE|NODE_TYPE_VERSION|PSEUDOATOM|FIELD_[0-9]+_.*)$")
+
+	def __init__(self,location,mode='r',title="",swmr=False):
+		importH5py()
+		if H5pyBackend.BOOL_TYPE is None:
+			H5pyBackend.BOOL_TYPE = h5py.h5t.decode(self.BOOL_TYPE_ENCODED)
+		self.swmr = swmr
+		self.mode = mode
+		if swmr:
+			self.h5file = h5py.File(location,mode,libver='latest',swmr=(mode == 'r'))
+		else:
+			self.h5file = h5py.File(location,mode)
+		self.__types = {}
+		self.__spaces = {}
+		if mode != 'r':
+			self.__tag(self.h5file,'GROUP','1.0',title,{},PYTABLES_FORMAT_VERSION='2.1')
+
+	#
+	# Add the attributes PyTables uses to recognise nodes, so that files written
+	# by this backend are identical in layout to those written with PyTables,
+	# together with the user attributes `attrs`.
+	def __tag(self,node,cls,version,title,attrs,**extra):
+		tags = {'CLASS':cls,'VERSION':version,'TITLE':title}
+		tags.update(extra)
+		tags.update(attrs or {})
+		self.set_attrs(node,tags)
+
+	#
+	# HDF5 types and dataspaces are reused between nodes and attributes of the
+	# same dtype and shape.
+	def __type(self,dtype):
+		if dtype not in self.__types:
+			self.__types[dtype] = h5py.h5t.py_create(dtype)
+		return self.__types[dtype]
+
+	def __space(self,array):
+		if array.shape not in self.__spaces:
+			if array.shape == ():
+				self.__spaces[array.shape] = h5py.h5s.create(h5py.h5s.SCALAR)
+			else:
+				self.__spaces[array.shape] = h5py.h5s.create_simple(array.shape)
+		return self.__spaces[array.shape]
+
+	@property
+	def root(self):
+		return self.h5file
+
+	def close(self):
+		self.h5file.close()
+
+	@property
+	def is_open(self):
+		return bool(self.h5file.id.valid)
+
+	def create_group(self,parent,name,title="",attrs=None):
+		group = parent.create_group(name)
+		self.__tag(group,'GROUP','1.0',title,attrs)
+		return group
+
+	#
+	# Arrays are created with the low-level API, which avoids much of the
+	# overhead of `create_dataset` when writing many small arrays. Files opened
+	# for SWMR have their arrays (booleans included) chunked, and extendable
+	# along their first axis; scalars, having no axes, cannot be extended.
+	def create_array(self,parent,name,array,title="",attrs=None,filters=None):
+		array = utf8Array(array)
+		if array.dtype == np.bool_:
+			array,htype,mtype = array.astype(np.uint8),self.BOOL_TYPE,self.BOOL_TYPE
+		else:
+			htype,mtype = self.__type(array.dtype),None
+		if self.swmr and array.ndim > 0:
+			if filters is None:
+				dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+				dcpl.set_chunk(chunkShape(array.shape,array.dtype.itemsize))
+			else:
+				dcpl = self.__filters(filters)
+			space = h5py.h5s.create_simple(array.shape,(h5py.h5s.UNLIMITED,)+array.shape[1:])
+		else:
+			dcpl,space = self.__filters(filters),self.__space(array)
+		dataset = h5py.Dataset(h5py.h5d.create(parent.id,byteString(name),htype,space,dcpl=dcpl))
+		if array.size > 0:
+			dataset.id.write(h5py.h5s.ALL,h5py.h5s.ALL,np.ascontiguousarray(array),mtype=mtype)
+		if filters is None:
+			self.__tag(dataset,'ARRAY','2.4',title,attrs,FLAVOR='numpy')
+		else:
+			self.__tag(dataset,'CARRAY','1.1',title,attrs)
+		return dataset
+
+	#
+	# The dataset creation properties (chunking, shuffling and deflation, in that
+	# order as with PyTables) for a `compression.Choice`
+	@staticmethod
+	def __filters(filters):
+		if filters is None:
+			return None
+		dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+		dcpl.set_chunk(filters.chunks)
+		if filters.shuffle:
+			dcpl.set_shuffle()
+		dcpl.set_deflate(filters.level)
+		return dcpl
+
+	def create_table(self,parent,name,entries,title="",attrs=None):
+		dataset = parent.create_dataset(name,data=entries,maxshape=(None,),chunks=True)
+		fields = dict(("FIELD_%d_NAME"%i,field) for i,field in enumerate(entries.dtype.names))
+		self.__tag(dataset,'TABLE','2.7',title,attrs,NROWS=np.int64(len(entries)),**fields)
+		return dataset
+
+	def create_external_link(self,parent,name,filename,path="/"):
+		parent[name] = h5py.ExternalLink(filename,path)
+
+	#
+	# Attributes are written with the low-level API too; `AttributeManager`
+	# writes each one to a temporary attribute before renaming it.
+	def set_attrs(self,node,attrs):
+		for attribute,value in attrs.items():
+			value = utf8Array(pickleAttr(value))
+			if value.dtype == np.bool_:
+				value,htype,mtype = value.astype(np.uint8),self.BOOL_TYPE,self.BOOL_TYPE
+			else:
+				htype,mtype = self.__type(value.dtype),None
+			attribute = byteString(attribute)
+			if h5py.h5a.exists(node.id,attribute):
+				h5py.h5a.delete(node.id,attribute)
+			attr = h5py.h5a.create(node.id,attribute,htype,self.__space(value))
+			attr.write(np.ascontiguousarray(value),mtype=mtype)
+
+	#
+	# As with writing, nodes and attributes are read with the low-level API
+	def get_attrs(self,node):
+		args = {}
+		for i in range(h5py.h5a.get_num_attrs(node.id)):
+			attr = h5py.h5a.open(node.id,index=i)
+			name = nativeString(attr.name)
+			if not self.SYSTEM_ATTRS.match(name):
+				args[name] = self.__read_attr(node,attr)
+		return args
+
+	def get_attr(self,node,name,default=None):
+		name = byteString(name)
+		if not h5py.h5a.exists(node.id,name):
+			return default
+		return self.__read_attr(node,h5py.h5a.open(node.id,name))
+
+	def __read_attr(self,node,attr):
+		htype = attr.get_type()
+		if isinstance(htype,h5py.h5t.TypeBitfieldID):
+			value = np.empty(attr.shape,dtype=np.uint8)
+			attr.read(value,mtype=htype)
+			return value.astype(np.bool_)[()]
+		if attr.dtype.hasobject: # e.g. variable length strings, left to h5py
+			return nativeAttr(node.attrs[attr.name])
+		if attr.shape is None: # Empty strings, as PyTables writes them
+			return nativeAttr(np.zeros((),dtype=attr.dtype)[()])
+		value = np.empty(attr.shape,dtype=attr.dtype)
+		attr.read(value)
+		return nativeAttr(unpickleAttr(value[()]))
+
+	def children(self,node):
+		return [(nativeString(name),child) for name,child in node.items()]
+
+	def is_group(self,node):
+		return isinstance(node,h5py.Group)
+
+	def read(self,node):
+		htype = node.id.get_type()
+		if isinstance(htype,h5py.h5t.TypeBitfieldID):
+			value = np.empty(node.id.shape,dtype=np.uint8)
+			node.id.read(h5py.h5s.ALL,h5py.h5s.ALL,value,mtype=htype)
+			return value.astype(np.bool_)
+		if node.id.dtype.hasobject:
+			return node[()]
+		value = np.empty(node.id.shape,dtype=node.id.dtype)
+		if value.size > 0:
+			node.id.read(h5py.h5s.ALL,h5py.h5s.ALL,value)
+		return value[()] if value.ndim == 0 else value
+
+	def get_node(self,path):
+		return self.h5file[path]
+
+	def has_node(self,path):
+		return path in self.h5file
+
+	def remove_node(self,path):
+		del self.h5file[path]
+
+	def start_swmr(self):
+		self.h5file.flush()
+		self.h5file.swmr_mode = True
+
+	def append(self,node,values):
+		if len(node.maxshape) == 0 or node.maxshape[0] is not None:
+			raise errors.BackendError("The node '%s' cannot be extended." % nativeString(node.name))
+		bitfield = isinstance(node.id.get_type(),h5py.h5t.TypeBitfieldID)
+		values = np.asarray(values,dtype=np.bool_ if bitfield else node.dtype)
+		n = node.shape[0]
+		node.resize(n+len(values),axis=0)
+		self.write_rows(node,n,values)
+		node.flush()
+
+	def refresh(self,node):
+		node.refresh()
+		return node.shape
+
+	def flush(self):
+		self.h5file.flush()
+
+	def chunks(self,node):
+		return node.chunks
+
+	#
+	# Booleans (see `BOOL_TYPE`) are read and written with the low-level API,
+	# a hyperslab of rows at a time.
+	def read_rows(self,node,start,stop):
+		htype = node.id.get_type()
+		if not isinstance(htype,h5py.h5t.TypeBitfieldID):
+			return node[start:stop]
+		value = np.empty((max(min(stop,node.shape[0])-start,0),)+node.shape[1:],dtype=np.uint8)
+		if value.size > 0:
+			node.id.read(h5py.h5s.create_simple(value.shape),self.__rows(node,start,value.shape),value,mtype=htype)
+		return value.astype(np.bool_)
+
+	def create_empty_array(self,parent,name,shape,dtype,chunks,title="",attrs=None):
+		dtype = np.dtype(dtype)
+		htype = self.BOOL_TYPE if dtype == np.bool_ else self.__type(dtype)
+		dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+		dcpl.set_chunk(tuple(chunks))
+		dataset = h5py.Dataset(h5py.h5d.create(parent.id,byteString(name),htype,h5py.h5s.create_simple(tuple(shape)),dcpl=dcpl))
+		self.__tag(dataset,'CARRAY','1.1',title,attrs)
+		return dataset
+
+	def write_rows(self,node,start,values):
+		values = np.ascontiguousarray(values)
+		if values.size == 0:
+			return
+		if values.dtype == np.bool_:
+			node.id.write(h5py.h5s.create_simple(values.shape),self.__rows(node,start,values.shape),values.astype(np.uint8),mtype=self.BOOL_TYPE)
+		else:
+			node[start:start+len(values)] = values
+
+	#
+	# The dataspace of `node`, with `shape` rows selected from row `start`
+	@staticmethod
+	def __rows(node,start,shape):
+		space = node.id.get_space()
+		space.select_hyperslab((start,)+(0,)*(len(shape)-1),shape)
+		return space
+
+BACKENDS = {
+	'pytables': PyTablesBackend,
+	'h5py': H5pyBackend,
+}
+
+DEFAULT_BACKEND = 'pytables'
+
+#
+# Open an HDF5 file with the named backend (or a Backend subclass)
+def openFile(location,mode='r',title="",backend=None,swmr=False):
+	if backend is None:
+		backend = DEFAULT_BACKEND
+	if isinstance(backend,str):
+		if backend not in BACKENDS:
+			raise errors.BackendError("Unknown backend '%s'. Available backends are: %s." % (backend,", ".join(sorted(BACKENDS))))
+		backend = BACKENDS[backend]
+	return backend(location,mode=mode,title=title,swmr=swmr)
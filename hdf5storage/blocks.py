@@ -0,0 +1,141 @@
+import collections, functools
+import numpy as np
+
+from .interfaces import HDF5LeafArray
+from .compression import chunkShape
+from . import errors
+
+#################### BLOCKWISE PROCESSING ######################################
+#
+# Arrays larger than memory are processed a block of rows (along their first
+# axis) at a time, with `Storage.map_blocks` and `Storage.reduce_blocks`:
+#
+# >>> d = Storage._load('large.hdf5',lazy=True,mode='a')
+# >>> d.map_blocks('x',np.sqrt,out='sqrt_x')
+# >>> total = d.reduce_blocks('x',np.sum,lambda a,b: a+b)
+#
+# Blocks hold about `block_bytes` worth of rows, rounded to whole chunks of the
+# stored array so that no chunk is read (or decompressed) twice. Blocks are read
+# in order by the calling thread, since HDF5 is not thread-safe, and are passed
+# to `func` in a pool of `workers` threads (numpy releases the GIL for most
+# operations on large arrays, and threads need not pickle `func`). At most
+# `workers` blocks are waiting for, or being processed by, the pool at once, so
+# that memory use is bounded by about (workers+1) blocks, and their results.
+
+BLOCK_BYTES = 32*1024**2
+
+#
+# Reads the rows of an array leaf, either from the file it was lazily loaded
+# from (without reading the rest of the array) or from its value in memory.
+class BlockReader(object):
+
+	def __init__(self,leaf,block_bytes=None):
+		if not isinstance(leaf,HDF5LeafArray):
+			raise errors.InvalidNodeError("Only arrays can be processed blockwise; '%s' is not an array." % leaf.name)
+		source = leaf._hdf5_source
+		if source is not None:
+			h5file,node = source.h5file,source.h5file.get_node(source.path)
+			self.shape,chunks = tuple(node.shape),h5file.chunks(node)
+			self.read = lambda start,stop: h5file.read_rows(node,start,stop)
+		else:
+			value = leaf.value
+			self.shape,chunks = value.shape,None
+			self.read = lambda start,stop: value[start:stop]
+		if len(self.shape) == 0:
+			raise errors.InvalidNodeError("The array '%s' is a scalar, and has no rows to process." % leaf.name)
+
+		rowBytes = max(self.read(0,1).nbytes,1)
+		step = chunks[0] if chunks else 1
+		self.rows = max(1,(block_bytes or BLOCK_BYTES)//(rowBytes*step))*step
+
+	def __len__(self):
+		return self.shape[0]
+
+	#
+	# The (start,stop) bounds of each block; an empty array has one, empty, block
+	def bounds(self):
+		if len(self) == 0:
+			return [(0,0)]
+		return [(start,min(start+self.rows,len(self))) for start in range(0,len(self),self.rows)]
+
+#
+# Yield (start,stop,func(block)) for each block of `reader`, in order
+def applyBlocks(reader,func,workers=None):
+	import multiprocessing, multiprocessing.pool
+	workers = workers if workers is not None else multiprocessing.cpu_count()
+	if workers <= 1:
+		for start,stop in reader.bounds():
+			yield start,stop,func(reader.read(start,stop))
+		return
+
+	pool = multiprocessing.pool.ThreadPool(workers)
+	pending = collections.deque()
+	try:
+		for start,stop in reader.bounds():
+			pending.append( (start,stop,pool.apply_async(func,(reader.read(start,stop),))) )
+			if len(pending) >= workers:
+				start,stop,result = pending.popleft()
+				yield start,stop,result.get()
+		while pending:
+			start,stop,result = pending.popleft()
+			yield start,stop,result.get()
+	finally:
+		pool.terminate()
+		pool.join()
+
+#
+# Apply `func` to each block of `reader`, writing the results to `sink` (see
+# below), which is opened with the shape and dtype of the results once the
+# first is known. Results must have as many rows as their blocks.
+def mapBlocks(reader,func,sink,workers=None):
+	for start,stop,result in applyBlocks(reader,func,workers):
+		result = np.asarray(result)
+		if result.ndim == 0 or len(result) != stop-start:
+			raise ValueError("Blockwise functions must return one row per row of their block; got %s for %d rows." % (result.shape,stop-start))
+		if start == 0:
+			sink.open((len(reader),)+result.shape[1:],result.dtype)
+		sink.write(start,result)
+	return sink.close()
+
+#
+# Apply `func` to each block of `reader`, combining the results in order with
+# `combine(a,b)`.
+def reduceBlocks(reader,func,combine,workers=None):
+	return functools.reduce(combine,(result for start,stop,result in applyBlocks(reader,func,workers)))
+
+#
+# Sinks collect the results of `mapBlocks`, either into an array in memory
+# or into a new array in a file.
+class ArraySink(object):
+
+	def open(self,shape,dtype):
+		self.value = np.empty(shape,dtype=dtype)
+
+	def write(self,start,values):
+		self.value[start:start+len(values)] = values
+
+	def close(self):
+		return self.value
+
+class FileSink(object):
+
+	def __init__(self,h5file,parent,name,attrs):
+		self.h5file = h5file
+		self.parent = parent
+		self.name = name
+		self.attrs = attrs
+
+	# Arrays with no elements cannot be chunked, and are written as they are
+	def open(self,shape,dtype):
+		if 0 in shape:
+			self.node = self.h5file.create_array(self.parent,self.name,np.empty(shape,dtype=dtype),attrs=self.attrs)
+		else:
+			self.node = self.h5file.create_empty_array(self.parent,self.name,shape,dtype,chunkShape(shape,dtype.itemsize),attrs=self.attrs)
+
+	def write(self,start,values):
+		if values.size > 0:
+			self.h5file.write_rows(self.node,start,values)
+
+	def close(self):
+		self.h5file.flush()
+		return self.node
@@ -0,0 +1,182 @@
+import sys
+from collections import OrderedDict
+import numpy as np
+
+from . import errors
+
+#################### LEAF VALUE CACHE ##########################################
+#
+# Storage objects loaded lazily (see `Storage._load`) keep their file open, and
+# read the values of their leaves only when they are first accessed. Values so
+# read are kept in a LeafCache, which holds at most `max_bytes` worth of values;
+# once full, the least recently used values are evicted (to be read again from
+# the file when next needed). A cache may be given to each lazily loaded
+# Storage object; otherwise the process-wide default cache is used.
+
+DEFAULT_MAX_BYTES = 256*1024**2
+
+#
+# Estimate the memory held by a leaf value
+def valueSize(value):
+	if isinstance(value,np.ndarray):
+		return sys.getsizeof(value) + (value.nbytes if value.base is not None else 0)
+	if isinstance(value,dict):
+		return sys.getsizeof(value) + sum(valueSize(k)+valueSize(v) for k,v in value.items())
+	if isinstance(value,(list,tuple)):
+		return sys.getsizeof(value) + sum(valueSize(v) for v in value)
+	return sys.getsizeof(value)
+
+class LeafCache(object):
+
+	def __init__(self,max_bytes=DEFAULT_MAX_BYTES):
+		self.max_bytes = max_bytes
+		self.__entries = OrderedDict()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __repr__(self):
+		return "<LeafCache with %d values (%d of %d bytes); %d hits, %d misses, %d evictions>" % (len(self),self.nbytes,self.max_bytes,self.hits,self.misses,self.evictions)
+
+	def __len__(self):
+		return len(self.__entries)
+
+	def __contains__(self,key):
+		return key in self.__entries
+
+	#
+	# Return the value cached for `key`, calling `load()` to produce it if it
+	# is not cached. Values larger than the whole budget are never cached.
+	def get(self,key,load):
+		entry = self.__entries.pop(key,None)
+		if entry is not None:
+			self.hits += 1
+			self.__entries[key] = entry
+			return entry[0]
+
+		self.misses += 1
+		value = load()
+		size = valueSize(value)
+		if size <= self.max_bytes:
+			self.__entries[key] = (value,size)
+			self.nbytes += size
+			self.__evict()
+		return value
+
+	def discard(self,key):
+		entry = self.__entries.pop(key,None)
+		if entry is not None:
+			self.nbytes -= entry[1]
+
+	#
+	# Discard the values read from the (backend) file `h5file`
+	def discard_file(self,h5file):
+		for key in [key for key in self.__entries if key.h5file is h5file]:
+			self.discard(key)
+
+	def clear(self):
+		self.__entries.clear()
+		self.nbytes = 0
+
+	def reset_stats(self):
+		self.hits = self.misses = self.evictions = 0
+
+	@property
+	def stats(self):
+		return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,'nbytes':self.nbytes,'entries':len(self)}
+
+	def __evict(self):
+		while self.nbytes > self.max_bytes:
+			key,(value,size) = self.__entries.popitem(last=False)
+			self.nbytes -= size
+			self.evictions += 1
+
+DEFAULT_CACHE = LeafCache()
+
+def getDefaultCache():
+	return DEFAULT_CACHE
+
+#
+# Replace the process-wide cache, either by another LeafCache or by a new cache
+# with the given budget (in bytes).
+def setDefaultCache(cache):
+	global DEFAULT_CACHE
+	if not isinstance(cache,LeafCache):
+		cache = LeafCache(max_bytes=cache)
+	DEFAULT_CACHE = cache
+	return cache
+
+#
+# Dictionaries loaded lazily are read-only, as are arrays. Copies of them are
+# ordinary (writable) dictionaries.
+class ReadOnlyDict(dict):
+	__slots__ = ()
+	
+	def __readonly(self,*args,**kwargs):
+		raise TypeError("Lazily loaded values are read-only; use `set_value` to change the value of their leaf.")
+	
+	__setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __readonly
+	
+	def __reduce__(self):
+		return (dict,(dict(self),))
+
+#
+# Make a loaded value read-only, including the arrays held by dictionaries
+def readOnly(value):
+	if isinstance(value,np.ndarray):
+		value.flags.writeable = False
+	elif isinstance(value,dict):
+		for item in value.values():
+			readOnly(item)
+		value = ReadOnlyDict(value)
+	return value
+
+#
+# The location of a leaf's value in an open file, used in place of the value by
+# lazily loaded leaves. Values so loaded are read-only (see `readOnly`), since
+# changes to them would be lost whenever they are evicted from the cache; use
+# `set_value` to change the value of such a leaf.
+class LeafSource(object):
+	__slots__ = ('h5file','path','populator','cache','shape')
+
+	def __init__(self,h5file,path,populator,cache):
+		self.h5file = h5file
+		self.path = path
+		self.populator = populator
+		self.cache = cache
+		self.shape = None
+
+	def __repr__(self):
+		return "<LeafSource '%s'>" % self.path
+
+	# Sources refer to an open file, and so are shared rather than copied
+	def __copy__(self):
+		return self
+
+	def __deepcopy__(self,memo):
+		return self
+
+	# Pickled sources become their (read-only) values, as they cannot refer to
+	# the file from another process
+	def __reduce__(self):
+		return (readOnly,(self.value,))
+
+	@property
+	def value(self):
+		return self.cache.get(self,self.load)
+
+	def load(self):
+		if not self.h5file.is_open:
+			raise errors.BackendError("Cannot read '%s'; the file it was lazily loaded from has been closed." % self.path)
+		node = self.h5file.get_node(self.path)
+		self.shape = node.shape
+		return readOnly(self.populator._hdf5_populate(self.h5file,node)['data'])
+
+	#
+	# Bring the node up to date with a file being written (see
+	# `backends.Backend.refresh`); the cached value is only discarded if the
+	# node has grown since it was read.
+	def refresh(self):
+		if self.h5file.refresh(self.h5file.get_node(self.path)) != self.shape:
+			self.cache.discard(self)
@@ -0,0 +1,151 @@
+import time, zlib
+import numpy as np
+
+from .utility import RESERVED_ATTR_PREFIX, utf8Array
+
+#################### COMPRESSION POLICY ########################################
+#
+# Arrays may be compressed as they are written (see `Storage.save`), with a codec
+# and chunk shape chosen for each array by a CompressionPolicy. The policy trial
+# compresses a small sample of the array with each candidate codec and level,
+# and chooses the candidate best meeting its goal:
+#
+#  - 'ratio': the smallest compressed size;
+#  - 'speed': the fastest decompression, of those candidates which compress the
+#    sample by at least `min_ratio` (or no compression at all, if none do).
+#
+# Only zlib (with or without the shuffle filter) is tried, since it is the only
+# codec which both PyTables and h5py (and so every backend) can read. The time
+# spent choosing is bounded by the size of the sample, and by `time_budget`;
+# candidates are not tried once the budget is spent. The choice is recorded in
+# the (reserved) attributes of each array, `COMPRESSION_ATTRS`; as is the time
+# it took, if the policy is made with `record_time=True` (by default it is not,
+# so that saving the same data twice writes the same file).
+
+CHUNK_BYTES = 256*1024
+
+COMPRESSION_ATTRS = tuple(RESERVED_ATTR_PREFIX + attr for attr in ('compression','compression_level','compression_shuffle','compression_chunks','compression_ratio','compression_time'))
+
+#
+# The chunk shape for an array: trailing dimensions are kept whole where
+# possible, and leading dimensions are split so that chunks hold about
+# `target` bytes.
+def chunkShape(shape,itemsize,target=CHUNK_BYTES):
+	chunks = list(shape)
+	for i in range(len(chunks)):
+		rest = max(1,itemsize*int(np.prod(chunks[i+1:])))
+		chunks[i] = max(1,min(chunks[i],target//rest))
+		if rest <= target:
+			break
+	return tuple(chunks)
+
+#
+# Reorder bytes as the HDF5 shuffle filter does: all first bytes of each item,
+# then all second bytes, and so on.
+def shuffle(data,itemsize):
+	return np.ascontiguousarray(np.frombuffer(data,dtype=np.uint8).reshape(-1,itemsize).T).tobytes()
+
+class Choice(object):
+
+	def __init__(self,codec,level=0,shuffle=False,chunks=None,ratio=1.0,rate=float('inf')):
+		self.codec = codec
+		self.level = level
+		self.shuffle = shuffle
+		self.chunks = chunks
+		self.ratio = ratio
+		self.rate = rate
+		self.time = None
+
+	def __repr__(self):
+		return "<Choice %s level %d%s; ratio %.2f>" % (self.codec,self.level,", shuffled" if self.shuffle else "",self.ratio)
+
+	@property
+	def compressed(self):
+		return self.codec != 'none'
+
+	@property
+	def attrs(self):
+		attrs = {'compression':self.codec,'compression_ratio':self.ratio}
+		if self.compressed:
+			attrs.update({'compression_level':self.level,'compression_shuffle':self.shuffle,'compression_chunks':np.array(self.chunks)})
+		if self.time is not None:
+			attrs['compression_time'] = self.time
+		return dict((RESERVED_ATTR_PREFIX + attr,value) for attr,value in attrs.items())
+
+class CompressionPolicy(object):
+
+	GOALS = ('ratio','speed')
+
+	def __init__(self,goal='ratio',levels=(1,5,9),min_bytes=64*1024,sample_bytes=128*1024,chunk_bytes=CHUNK_BYTES,min_ratio=1.2,time_budget=0.05,samples=4,record_time=False):
+		if goal not in self.GOALS:
+			raise ValueError("Unknown compression goal '%s'. Use one of: %s." % (goal,", ".join(self.GOALS)))
+		self.goal = goal
+		self.levels = levels
+		self.min_bytes = min_bytes
+		self.sample_bytes = sample_bytes
+		self.chunk_bytes = chunk_bytes
+		self.min_ratio = min_ratio
+		self.time_budget = time_budget
+		self.samples = samples
+		self.record_time = record_time
+
+	def __repr__(self):
+		return "<CompressionPolicy for %s>" % self.goal
+
+	#
+	# Returns the Choice for `array`, or None if the array is to be written as
+	# it is (being too small, a scalar, or not numeric). Text is sampled as it
+	# is stored, encoded as UTF-8.
+	def select(self,array):
+		start = time.time()
+		array = utf8Array(array)
+		if array.ndim == 0 or array.nbytes < self.min_bytes or array.dtype.hasobject:
+			return None
+
+		itemsize = array.dtype.itemsize
+		chunks = chunkShape(array.shape,itemsize,self.chunk_bytes)
+		blocks = self.__sample(array,int(np.prod(chunks)))
+		size = sum(len(block) for block in blocks)
+
+		best = Choice('none',chunks=None)
+		for level in self.levels:
+			for shuffled in ([False,True] if itemsize > 1 else [False]):
+				if time.time()-start > self.time_budget:
+					break
+				data = [shuffle(block,itemsize) for block in blocks] if shuffled else blocks
+				compressed = [zlib.compress(block,level) for block in data]
+				decoding = time.time()
+				for block in compressed:
+					zlib.decompress(block)
+				decoding = time.time()-decoding
+
+				candidate = Choice('zlib',level,shuffled,chunks,ratio=float(size)/sum(len(block) for block in compressed),rate=size/max(decoding,1e-9))
+				if self.__better(candidate,best):
+					best = candidate
+
+		if self.record_time:
+			best.time = time.time()-start
+		return best
+
+	def __better(self,candidate,best):
+		if self.goal == 'ratio':
+			return (candidate.ratio,candidate.rate) > (best.ratio,best.rate)
+		if candidate.ratio < self.min_ratio:
+			return False
+		return not best.compressed or candidate.rate > best.rate
+
+	#
+	# Take up to `samples` evenly spaced blocks of (at most) a chunk's worth of
+	# items, and no more than `sample_bytes` in all.
+	def __sample(self,array,chunkItems):
+		flat = np.ascontiguousarray(array).reshape(-1)
+		items = max(1,min(chunkItems,self.sample_bytes//(self.samples*array.dtype.itemsize)))
+		starts = np.linspace(0,max(len(flat)-items,0),self.samples).astype(int)
+		return [flat[i:i+items].tobytes() for i in sorted(set(starts))]
+
+#
+# Returns the policy for `compression`, which is either a policy or a goal
+def getPolicy(compression):
+	if compression is None or isinstance(compression,CompressionPolicy):
+		return compression
+	return CompressionPolicy(goal=compression)
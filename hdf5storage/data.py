@@ -1,15 +1,35 @@
-import re
-import tables
-
+import os, re, copy
 import warnings
-warnings.filterwarnings('ignore',category=tables.NaturalNameWarning)
 
 import numpy as np
 
 from .interfaces import DataNode,DataGroup,DataLeaf,HDF5Node,HDF5Group,HDF5Leaf,HDF5LeafTable,HDF5LeafArray
-from . import errors
+from . import errors, backends, matlab, live, blocks
+from . import cache as leafcache
+from .compression import getPolicy as compressionPolicy
+from .digest import getPolicy as digestPolicy
+
+from .utility import NUMBER_TYPES, encodeNumbers, decodeNumbers, cachedByType, walk
 
-from utility import decodeNumbers
+NODE_NAME_PATTERN = re.compile(r"^[a-zA-Z][a-zA-Z_0-9]*$")
+
+#
+# Decode a node name, and check that it is usable as such
+def validateNodeName(name):
+	# Plain names cannot be encoded numbers, so they need no decoding
+	if isinstance(name,str) and NODE_NAME_PATTERN.match(name):
+		return name
+	name = decodeNumbers(name)
+	if isinstance(name,str):
+		if not NODE_NAME_PATTERN.match(name):
+			raise errors.InvalidNodeNameError("Node names must be a string with length > 0 and that start with a letter. '%s' was provided."%name)
+	elif not isinstance(name,NUMBER_TYPES):
+		raise errors.InvalidNodeNameError("'%s'"%name)
+	return name
+
+#
+# Names of group nodes which would be shadowed by methods of their parent type
+reservedNames = cachedByType(lambda cls: frozenset(dir(cls)))
 
 #################### The Main DATA CLASS #######################################
 #
@@ -19,10 +39,10 @@ class Storage(HDF5Group,DataGroup):
 	Storage (name="",attrs={})
 	
 	The storage object that acts somewhat like a dictionary, and that can be
-	output to disk as an HDF5 formatted data set (or as a series of matlab
-	files). The Storage library is designed mostly for numeric data; though
-	rudimentary support for strings exists also. Do not expect more complicated
-	objects to work.
+	output to disk as an HDF5 formatted data set (or as a matlab file). The
+	Storage library is designed mostly for numeric data; though rudimentary
+	support for strings exists also. Do not expect more complicated objects to
+	work.
 
 	In particular, the storage library is designed to work with any number 
 	format with which numpy is familiar. The internal storage format used by
@@ -85,10 +105,12 @@ class Storage(HDF5Group,DataGroup):
 	d.x.y.leaf('test').set_attrs(auto=True)
 	d.node_attrs('x/y/test',attrs={'auto':True})
 	'''
+	__slots__ = ('__children','__attributes','__file')
 	
 	def __init__(self,name="",attrs={}):
 		self.set_name(name)
 		self.__children = {}
+		self.__file = None
 		self.__attributes = {'type':'storage'}
 		self.set_attrs(**attrs)
 	
@@ -98,27 +120,23 @@ class Storage(HDF5Group,DataGroup):
 	def __repr__(self):
 		return "<Storage with %d groups and %d leaves>" % (len(self.groups),len(self.leaves))
 
-	def structure(self,depth=0):
-		nl = "|"
-		output = []
-		if depth == 0:
-			output = ["Storage:%s"%self.name]
-		leaves = []
-		nodes = []
-		for node,value in self.__children.items():
-			if isinstance(value,Storage):
-				nodes.append("+%s"%value.name)
-				nodes.extend(map(lambda x: "%s%s"%(nl,x),value.structure(depth=depth+1)))
-			else:
-				leaves.append('-'+node)
-				
-		if len(nodes) > 0:
-			output.extend(nodes)
-		if len(leaves) > 0:
-			output.extend(leaves)
+	def structure(self):
+		output = ["Storage:%s"%self.name]
 		
-		if depth > 0:
-			return output
+		# Items are (group,depth) or (leaf name,depth); subgroups are listed
+		# (with their contents) before leaves.
+		def visit(item):
+			node,depth = item
+			if not isinstance(node,Storage):
+				output.append("%s-%s"%("|"*(depth-1),node))
+				return
+			if depth > 0:
+				output.append("%s+%s"%("|"*(depth-1),node.name))
+			children = node.__children.items()
+			return [(value,depth+1) for name,value in children if isinstance(value,Storage)] + \
+					[(name,depth+1) for name,value in children if not isinstance(value,Storage)]
+		
+		walk((self,0),visit)
 		return "\n|".join(output)
 	
 	def __dir__(self):
@@ -145,22 +163,27 @@ class Storage(HDF5Group,DataGroup):
 	def _add_node(self,name,data=None,dtype=None,attrs={}):
 		if isinstance(data,Storage): # Merge data type if name is none
 			if name is None or name == '':
-				self.__children.update(copy.deepcopy(data._children)) 
+				self.__children.update(copy.deepcopy(data.__children))
 				return
 		
-		name = decodeNumbers(name)
-		if isinstance(name,str):
-			if name is None or not re.match("^[a-zA-Z][a-zA-Z\_0-9]*$",name):
-				raise errors.InvalidNodeNameError("Node names must be a string with length > 0 and that start with a letter. '%s' was provided."%name)
-		elif isinstance(name,(int,float,long,complex)):
-			pass
-		else:
-			raise errors.InvalidNodeNameError("'%s'"%name)
-
-		self.__children[name] = getDataType(name=name,data=data,dtype=dtype,attrs=attrs)
-		if isinstance(self.__children[name],DataGroup):
-				if name in dir(type(self)):
-					warnings.warn(errors.InaccessibleGroupNodeWarning("The name chosen for the group node '%s' will not be accessible as an attribute, because it clashes with the name of a method."%name))
+		name = validateNodeName(name)
+		self.__set_child(name,getDataType(name=name,data=data,dtype=dtype,attrs=attrs))
+	
+	def _node_name(self,name):
+		return validateNodeName(name)
+	
+	def _node_data(self,name,data):
+		return getDataType(name=name,data=data)
+	
+	# Names and data have already been checked and converted by `add_nodes`
+	def _add_nodes(self,nodes):
+		for name,child in nodes:
+			self.__set_child(name,child)
+	
+	def __set_child(self,name,child):
+		self.__children[name] = child
+		if name in reservedNames(type(self)) and isinstance(child,DataGroup):
+			warnings.warn(errors.InaccessibleGroupNodeWarning("The name chosen for the group node '%s' will not be accessible as an attribute, because it clashes with the name of a method."%name))
 
 	def _pop_node(self,node):
 		return self.__children.pop(node)
@@ -190,52 +213,256 @@ class Storage(HDF5Group,DataGroup):
 		return ""
 	
 	@classmethod
-	def _hdf5_populate(cls,hdfNode):
-		args = {}
-		for attr in hdfNode._v_attrs._f_list():
-			args[attr] = getattr(hdfNode._v_attrs,attr)
-		return {'data':Storage._from_node(hdfNode,prefix=hdfNode._v_pathname),'args':args}
+	def _hdf5_populate(cls,h5file,hdfNode):
+		return {'data':Storage._from_node(h5file,hdfNode),'args':h5file.get_attrs(hdfNode)}
 	
 	######################### DATA ARCHIVAL METHODS ############################
 	
 	#
 	# Save the data
 	def __rshift__(self,location):
+		self.save(location)
+	
+	#
+	# Save the data, using the named HDF5 backend (see `backends.BACKENDS`).
+	# Arrays are compressed as chosen by `compression`, a goal ('ratio' or
+	# 'speed') or a `compression.CompressionPolicy`; or not at all, if None.
+	# Arrays and tables are written with digests of their contents as chosen
+	# by `digests` (see `digest.getPolicy`), for use by `diff` and `verify`.
+	# Locations ending in '.mat' are exported as MAT files (see `save_mat`).
+	def save(self,location,backend=None,compression=None,digests=None):
 		if location.endswith('.mat'):
-			name = location[:-4]
-			md = {}
-			for leaf in self.leaves:
-				md[leaf] = self[leaf]
-			import scipy.io as spio
-			spio.savemat("%s.%s.mat"%(name,self._hdf5_name),md)
-			for group in self.groups:
-				self.node(group).__rshift__("%s.%s.mat"%(name,self._hdf5_name))
+			self.save_mat(location)
 		else:
-			h5file = tables.openFile(location, mode = "w", title = self._hdf5_name)
-			self._hdf5_write(h5file,h5file.root);
+			compression,digests = compressionPolicy(compression),digestPolicy(digests)
+			h5file = backends.openFile(location, mode="w", title=self._hdf5_name, backend=backend)
+			h5file.compression,h5file.digests = compression,digests
+			try:
+				self._hdf5_write(h5file,h5file.root)
+			finally:
+				h5file.close()
+	
+	#
+	# Save the data across several files. Each of the groups at the node paths
+	# `shards` (by default, every top-level group) is written to a file of its
+	# own next to `location`; using a pool of `processes` worker processes, if
+	# given. `location` holds the rest of the tree, together with external links
+	# to the shards, and is loaded just as any other file. Returns the locations
+	# of the shards.
+	def save_shards(self,location,shards=None,backend=None,processes=None,compression=None,digests=None):
+		if shards is None:
+			shards = self.groups
+		groups = [self.node(shard) for shard in shards]
+		for shard,group in zip(shards,groups):
+			if not isinstance(group,Storage):
+				raise errors.InvalidNodeError("Only groups can be sharded; '%s' is a leaf." % shard)
+		
+		# Shards must not contain one another, since only the outer one would
+		# be linked to
+		ids = set(id(group) for group in groups)
+		for shard,group in zip(shards,groups):
+			def visit(node):
+				if node is not group and id(node) in ids:
+					raise errors.InvalidNodeError("The shard '%s' contains another shard." % shard)
+				return [child for child in node.__children.values() if isinstance(child,Storage)]
+			walk(group,visit)
+		
+		stem,ext = os.path.splitext(location)
+		locations = ["%s.%d%s" % (stem,i,ext) for i in range(len(groups))]
+		jobs = [(group,shardLocation,backend,compression,digests) for group,shardLocation in zip(groups,locations)]
+		if processes is None or processes <= 1:
+			for job in jobs:
+				saveShard(job)
+		else:
+			import multiprocessing
+			pool = multiprocessing.Pool(processes)
+			try:
+				pool.map(saveShard,jobs)
+			finally:
+				pool.close()
+				pool.join()
+		
+		links = dict((id(group),os.path.basename(shardLocation)) for group,shardLocation in zip(groups,locations))
+		h5file = backends.openFile(location, mode="w", title=self._hdf5_name, backend=backend)
+		h5file.compression,h5file.digests = compressionPolicy(compression),digestPolicy(digests)
+		try:
+			self._hdf5_write(h5file,h5file.root,links)
+		finally:
 			h5file.close()
+		return locations
 	
 	#
-	# Restore the data
+	# Export the data as a single MAT file, in which groups become (nested)
+	# structs, a leaf at a time. Version '5' files can be read by
+	# scipy.io.loadmat and by MATLAB, but hold at most 4GB per top-level node;
+	# version '7.3' files are HDF5 based, and suited to larger data sets.
+	def save_mat(self,location,version='5',do_compression=True):
+		matlab.saveMat(self,location,version=version,do_compression=do_compression)
+	
+	#
+	# Restore the data. Lazily loaded Storage objects keep the file open, and
+	# read the values of arrays and dictionaries only when they are accessed,
+	# keeping them in `cache` (or the process-wide cache; see `cache.LeafCache`)
+	# until they are evicted. Such objects should be closed once done with.
+	# Files being written with `save_live` are read with `swmr=True`. Files to
+	# which `map_blocks` is to write its results are opened with mode 'a'.
 	@classmethod
-	def _load(cls,location):
-		h5file = tables.openFile(location, mode='r')
-		data = cls._from_node(h5file.getNode('/'))
-		h5file.close()
-		return data
+	def _load(cls,location,backend=None,lazy=False,cache=None,swmr=False,mode='r'):
+		h5file = backends.openFile(location, mode=mode, backend=backend, swmr=swmr)
+		if not lazy:
+			try:
+				return cls._from_node(h5file,h5file.root)
+			finally:
+				h5file.close()
+		
+		cache = cache if cache is not None else leafcache.getDefaultCache()
+		try:
+			storage = cls._from_node(h5file,h5file.root,cache=cache)
+		except:
+			h5file.close()
+			raise
+		storage.__file = (h5file,cache)
+		return storage
+	
+	#
+	# The file from which an object was lazily loaded is not copied (or pickled)
+	# with it; only the object loaded can close it. Leaves of copies read from
+	# the file for as long as it is open, and pickled leaves hold their values.
+	def __getstate__(self):
+		return (self.name,self.__children,self.__attributes)
+	
+	def __setstate__(self,state):
+		name,self.__children,self.__attributes = state
+		self.set_name(name)
+		self.__file = None
+	
+	#
+	# Close the file from which this object was lazily loaded, if any
+	def close(self):
+		if self.__file is not None:
+			h5file,cache = self.__file
+			cache.discard_file(h5file)
+			h5file.close()
+			self.__file = None
+	
+	#
+	# Bring an object lazily loaded with `swmr=True` up to date with its file;
+	# only the leaves that have since been appended to are read again.
+	def refresh(self):
+		if self.__file is None:
+			raise errors.BackendError("Only Storage objects loaded lazily from a file can be refreshed.")
+		def visit(node):
+			subgroups = []
+			for child in node.__children.values():
+				if isinstance(child,Storage):
+					subgroups.append(child)
+				elif getattr(child,'_hdf5_source',None) is not None:
+					child._hdf5_source.refresh()
+			return subgroups
+		walk(self,visit)
+	
+	#
+	# Write the data to `location` for live monitoring, returning a
+	# `live.LiveWriter` with which to append to its arrays (see `live`).
+	def save_live(self,location):
+		return live.LiveWriter(self,location)
+	
+	#
+	# Apply `func` to the array at node path `path` a block of rows at a time,
+	# storing the results (which must have one row per row of their block) as
+	# a new array at `out`. In objects lazily loaded with mode 'a' (though not
+	# in their subgroups), the results are written straight to the file, and
+	# read from it as any other lazily loaded leaf; groups on the way to `out`
+	# which are not yet in the file are added to it, and should `func` fail,
+	# whatever was added is removed again. See `blocks` for `block_bytes` and
+	# `workers`.
+	def map_blocks(self,path,func,out,block_bytes=None,workers=None):
+		reader = blocks.BlockReader(self.node(path),block_bytes)
+		parentPath,name = self.__split_path(out)
+		parent = self.node(parentPath)
+		if name in parent.nodes:
+			raise errors.NodeExistsError("The node '%s' already exists." % out)
+		
+		if self.__file is None:
+			parent._add_node(name,data=blocks.mapBlocks(reader,func,blocks.ArraySink(),workers))
+			return parent._node(name)
+		
+		h5file,cache = self.__file
+		if h5file.mode == 'r':
+			raise errors.BackendError("The file of this Storage object is read-only; load it with mode 'a' to write to it.")
+		h5path = "".join("/" + encodeNumbers(group) for group in parentPath)
+		leafPath = h5path + "/" + encodeNumbers(name)
+		if h5file.has_node(leafPath):
+			raise errors.NodeExistsError("The node '%s' already exists in the file." % out)
+		
+		# The first group added to the file (if any) is removed should `func` fail
+		added = None
+		group,groupPath,node = self,"",h5file.get_node("/")
+		for groupName in parentPath:
+			group = group.node(groupName)
+			groupPath += "/" + group._hdf5_name
+			if not h5file.has_node(groupPath):
+				added = added or groupPath
+				node = h5file.create_group(node,group._hdf5_name,group._hdf5_desc,group._hdf5_attrs)
+			else:
+				node = h5file.get_node(groupPath)
+		try:
+			blocks.mapBlocks(reader,func,blocks.FileSink(h5file,node,encodeNumbers(name),DataArray(name)._hdf5_attrs),workers)
+		except:
+			if h5file.has_node(added or leafPath):
+				h5file.remove_node(added or leafPath)
+			raise
+		parent._add_node(name,data=DataArray(name,leafcache.LeafSource(h5file,leafPath,DataArray,cache)))
+		return parent._node(name)
+	
+	#
+	# Apply `func` to the array at node path `path` a block of rows at a time,
+	# returning the results combined (in order) by `combine(a,b)`.
+	def reduce_blocks(self,path,func,combine,block_bytes=None,workers=None):
+		return blocks.reduceBlocks(blocks.BlockReader(self.node(path),block_bytes),func,combine,workers)
+	
+	@staticmethod
+	def __split_path(path):
+		names = [name for name in (path.split('/') if isinstance(path,str) else path) if name != ""]
+		if len(names) == 0:
+			raise errors.InvalidNodeNameError("'%s' is not a valid node path." % path)
+		return names[:-1],decodeNumbers(names[-1])
 	
 	@classmethod
-	def _from_node(cls,node,prefix=""):
+	def _from_node(cls,h5file,node,cache=None):
 		retData = cls()
-		retData.__examine_nodes(node,prefix=prefix)
+		walk((retData,node,""),lambda item: Storage.__examine_nodes(h5file,item,cache))
 		return retData
 	
-	def __examine_nodes(self,node,prefix=""):
-		for leaf in node._v_leaves.values():
-			populateDataType(self,leaf,prefix=prefix)
-		for subnode in node._v_children.values():
-			if subnode is not None:
-				if not populateDataType(self,subnode,prefix=prefix):
-					self.__examineNodes(subnode,prefix=prefix)
+	#
+	# Restore the children of the HDF5 group `node` (at `path`) into `storage`,
+	# returning the (storage,node,path) items of the subgroups which remain to
+	# be examined.
+	@staticmethod
+	def __examine_nodes(h5file,item,cache=None):
+		storage,node,path = item
+		subgroups = []
+		for hdfName,child in h5file.children(node):
+			name = decodeNumbers(hdfName)
+			obj,dtype = getPopulator(h5file,child)
+			if obj is Storage:
+				group = Storage(name=name,attrs=h5file.get_attrs(child))
+				storage.__set_child(name,group)
+				subgroups.append( (group,child,path+"/"+hdfName) )
+			elif cache is not None and obj in LAZY_TYPES:
+				source = leafcache.LeafSource(h5file,path+"/"+hdfName,obj,cache)
+				storage.__set_child(name,obj(name,source,attrs=h5file.get_attrs(child)))
+			else:
+				extracted = obj._hdf5_populate(h5file,child)
+				storage.__set_child(name,getDataType(name=name,data=extracted['data'],dtype=dtype,attrs=extracted['args']))
+		return subgroups
+
+#
+# Write a single shard (see `Storage.save_shards`); a module level function so
+# that it can be sent to worker processes.
+def saveShard(job):
+	group,location,backend,compression,digests = job
+	group.save(location,backend=backend,compression=compression,digests=digests)
 
-from datatypes import getDataType, populateDataType
+# datatypes imports Storage from here, and so is imported once it is defined
+from .datatypes import getDataType, getPopulator, DataArray, LAZY_TYPES
@@ -1,26 +1,33 @@
-import os, math, copy
-import tables
+import copy
 import numpy as np
 
 from .interfaces import DataNode,DataGroup,DataLeaf,HDF5Node,HDF5Group,HDF5Leaf,HDF5LeafTable,HDF5LeafArray
 from .data import Storage
+from .utility import EMPTY_ATTRS, INTEGER_TYPES, NUMBER_TYPES, TEXT_TYPES, encodeNumbers, decodeNumbers, utf8Array
+from .cache import LeafSource
+from . import errors
 
 #################### DATA TYPE CLASSES #########################################
 
 #
 # Get the appropriate data type for the input data
 def getDataType(name,data=None,dtype=None,attrs={}):
+	# Fast path for scalars, which would otherwise only be recognised after
+	# several (slow) abstract base class checks.
+	if dtype is None and isinstance(data,NUMBER_TYPES+(str,np.generic)):
+		return DataArray(name,data,attrs=attrs)
+	
 	if isinstance(data,DataNode):
 		data = copy.copy(data)
-		data.set_name = name
+		data.set_name(name)
 		return data
 	
 	if dtype == 'array' or dtype is None and isinstance(data,np.ndarray):
 		return DataArray(name,data,attrs=attrs)
 	if dtype == 'storage' or dtype is None and isinstance(data,Storage):
-		children = copy.deepcopy(data._children)
 		dataObj = Storage(name=name,attrs=attrs)
-		dataObj._children = children
+		if data is not None:
+			dataObj._add_node(None,data=data)
 		return dataObj
 	if dtype == 'dict' or dtype is None and isinstance(data,dict):
 		return DataDict(name,data,attrs=attrs) 
@@ -39,62 +46,81 @@ def getDataType(name,data=None,dtype=None,attrs={}):
 	#	return DataVariableArray(name,data,**args)
 	#if dtype == 'string' or type(data) in [str]:
 	#	return DataString(name,data)
-	raise ValueError, "Unknown data type for type %s (%s)" % (str(type(data)),str(data))
+	raise ValueError("Unknown data type for type %s (%s)" % (str(type(data)),str(data)))
 
 #
-# Return true if populateDataType has handled all children of a node
-def populateDataType(dataObj,hdfNode,extractOnly = False,prefix=''):
-	try:
-		type = hdfNode._f_getAttr('type')
-	except AttributeError, e:
-		if extractOnly:
-			return None
-		return False
-	
-	path = hdfNode._v_pathname[len(prefix):]
-	name = os.path.basename(path)
-	node = os.path.dirname(path) if os.path.dirname(path) != '' else "/"
-	
-	if not hdfNode._v_pathname.startswith(prefix):
-		raise ValueError, "Invalid node (outside prefix)."
-	
-	if type == 'storage':
-		obj = Storage
-		dtype = 'storage'
-	elif type == 'data_dict':
-		obj = DataDict
-		dtype = 'dict'
-	elif type == 'data_array':
-		obj = DataArray
-		dtype = 'array'
-	elif type == 'data_variablearray':
-		obj = DataVariableArray
-		dtype = 'var_array'
-	elif type == "data_list":
-		obj = DataList
-		dtype = "list"
-	else:
-		raise ValueError, "Unknown data type %s"%type
-	
-	if issubclass(obj,HDF5Node):
-		extracted = obj._hdf5_populate(hdfNode)
-	else:
-		raise Exception("Unknown type")
-	
-	if extractOnly:
-		return extracted
-	
-	dataObj.add_node(name=name,parent=node,data=extracted['data'],dtype=dtype,attrs=extracted['args'])
-	return True
+# Return the class with which to restore `hdfNode`, together with its dtype.
+# Nodes not written by HDF5Storage are restored as plain groups and arrays.
+def getPopulator(h5file,hdfNode):
+	type = h5file.get_attr(hdfNode,'type')
+	if type is None:
+		type = 'storage' if h5file.is_group(hdfNode) else 'data_array'
+	
+	if type not in HDF5_TYPES:
+		raise ValueError("Unknown data type %s"%type)
+	return HDF5_TYPES[type]
+
+#
+# Text columns are stored as UTF-8 bytes (see `utf8Array`), and returned as
+# native strings
+def asTextList(values):
+	if values.dtype.kind == 'S' and str is not bytes:
+		values = np.char.decode(values,'utf-8')
+	return values.tolist()
+
+# Arrays of bytes which are not UTF-8 text are returned as they are
+def asTextValue(value):
+	value = np.asarray(value)
+	if value.dtype.kind == 'S' and str is not bytes:
+		try:
+			return np.char.decode(value,'utf-8')
+		except UnicodeDecodeError:
+			pass
+	return value
+
+#
+# The kinds of value which may share a column of a DataDict table; numpy kinds
+# not listed here (e.g. objects) cannot be stored in one.
+VALUE_KINDS = {'b':'bool','i':'integer','u':'integer','f':'float','c':'complex','S':'text','U':'text'}
+PYTHON_KINDS = dict([(bool,'bool'),(float,'float'),(complex,'complex')] + [(t,'integer') for t in INTEGER_TYPES] + [(t,'text') for t in TEXT_TYPES])
 
+#
+# Booleans and integers stored alongside floats are stored as floats, so long
+# as each is held exactly by a float64 (as every boolean is).
+FLOAT_EXACT = 2**53
+PROMOTED_KINDS = set(['bool','integer','float'])
+
+def exactFloat(value):
+	value = np.asarray(value)
+	return bool(np.all((value > -FLOAT_EXACT) & (value < FLOAT_EXACT)))
+
+#
+# The kind and shape of a value; Python scalars are recognised by their type,
+# since converting each to an array is slow for large dictionaries.
+def valueKind(value):
+	kind = PYTHON_KINDS.get(type(value))
+	if kind is not None:
+		return kind,()
+	value = np.asarray(value)
+	return VALUE_KINDS.get(value.dtype.kind),value.shape
+
+#
+# DataDict objects are stored as a single table with one row per entry. Keys
+# are stored in a string column as wide as the longest key, numbers encoded as
+# per `encodeNumbers`, next to a column of their kinds ('s' for strings and
+# 'n' for numbers). The type and shape of the value column are chosen from the
+# values themselves; all values must therefore be of the same kind and shape
+# (e.g. integers, complex numbers, fixed shape arrays or strings). The only
+# conversion made is that of booleans and integers to floats, when stored
+# alongside floats and held exactly by them (see `exactFloat`).
 class DataDict(HDF5LeafTable,DataLeaf):
-	
-	KEY_LENGTH = 30
+	__slots__ = ('__dict','__props')
 	
 	def __init__(self,name,data,attrs={}):
 		self.set_name(name)
 		self.__dict = data
-		self.__props = attrs
+		self.__props = EMPTY_ATTRS
+		self.set_attrs(**attrs)
 	
 	############## HDF5 Methods ############################################
 	
@@ -108,63 +134,95 @@ class DataDict(HDF5LeafTable,DataLeaf):
 		attrs.update(self.__props)
 		return attrs
 	
-	@property
-	def _hdf5_leaf_table_structure(self):
-		class DictTable(tables.IsDescription):
-			key_string = tables.StringCol(self.KEY_LENGTH)
-			key_float = tables.Float64Col()
-			value_float = tables.Float64Col()
-		return DictTable
-	
 	@property
 	def _hdf5_leaf_table_entries(self):
-		entries = []
-		for key,value in self.__dict.items():
-			if isinstance(key,str):
-				entries.append( {'key_string':key, 'key_float':None, 'value_float':value} )
-			else:
-				entries.append( {'key_string':None, 'key_float':key, 'value_float':value} )
+		if len(self.value) == 0:
+			return np.empty(0,dtype=[('key','S1'),('key_kind','S1'),('value','f8')])
+		
+		data = self.value
+		valueKinds = [valueKind(value) for value in data.values()]
+		kinds,shapes = set(kind for kind,shape in valueKinds),set(shape for kind,shape in valueKinds)
+		if len(shapes) > 1 or None in kinds or len(kinds) > 1 and not ('float' in kinds and kinds <= PROMOTED_KINDS):
+			raise ValueError("The values of the dictionary '%s' are not all of the same kind and shape, and so cannot be stored as a table." % self.name)
+		if len(kinds) > 1:
+			if not all(exactFloat(value) for value,(kind,shape) in zip(data.values(),valueKinds) if kind == 'integer'):
+				raise ValueError("The integers of the dictionary '%s' cannot be stored as floats without losing precision." % self.name)
+			kind,values = 'float',np.array(list(data.values()),dtype=np.float64)
+		else:
+			kind,values = kinds.pop(),utf8Array(list(data.values()))
+		if VALUE_KINDS.get(values.dtype.kind) != kind:
+			raise ValueError("The values of the dictionary '%s' cannot be stored as a table without converting them to %s." % (self.name,values.dtype))
+		
+		textKeys = [isinstance(key,TEXT_TYPES) for key in data.keys()]
+		keys = utf8Array([key if text else encodeNumbers(key) for key,text in zip(data.keys(),textKeys)])
+		entries = np.empty(len(keys),dtype=[('key',keys.dtype),('key_kind','S1'),('value',values.dtype,values.shape[1:])])
+		entries['key'] = keys
+		entries['key_kind'] = [b's' if text else b'n' for text in textKeys]
+		entries['value'] = values
 		return entries
 	
+	#
+	# The file location of a lazily loaded value, if any
+	@property
+	def _hdf5_source(self):
+		return self.__dict if isinstance(self.__dict,LeafSource) else None
+	
 	@classmethod
-	def _hdf5_populate(cls,hdfNode):
-		d = {}
-		for row in hdfNode.iterrows():
-			if math.isnan(row['key_float']):
-				d[row['key_string']] = row['value_float']
-			else:
-				d[row['key_float']] = row['value_float']
+	def _hdf5_populate(cls,h5file,hdfNode):
+		table = h5file.read(hdfNode)
 		
-		args = {}
-		for attr in hdfNode._v_attrs._f_list():
-			args[attr] = getattr(hdfNode._v_attrs,attr)
+		if 'key_float' in table.dtype.names: # Format used prior to typed tables
+			keys = asTextList(table['key_string'])
+			for i,key_float in enumerate(table['key_float'].tolist()):
+				if not np.isnan(key_float):
+					keys[i] = key_float
+			d = dict(zip(keys,table['value_float'].tolist()))
+		else:
+			keys = asTextList(table['key'])
+			if 'key_kind' in table.dtype.names:
+				keys = [decodeNumbers(key) if kind == b'n' else key for key,kind in zip(keys,table['key_kind'].tolist())]
+			else: # Format used prior to key kinds, in which only numbers were decoded
+				keys = [decodeNumbers(key) if '(' in key else key for key in keys]
+			values = table['value']
+			d = dict(zip(keys,list(values) if values.ndim > 1 else asTextList(values)))
 		
-		return {'data':d,'args':args}
+		return {'data':d,'args':h5file.get_attrs(hdfNode)}
 	
 	############## DataLeaf Methods #######################################
 	
 	@property
 	def value(self):
+		if isinstance(self.__dict,LeafSource):
+			return self.__dict.value
 		return self.__dict
 	
-	@property
 	def set_value(self,value):
-		self.__dict = dict
+		self.__dict = value
 	
+	#
+	# Nodes share EMPTY_ATTRS until they have attributes; the mapping returned
+	# here is always the node's own, so that it may be changed in place.
 	@property
 	def attrs(self):
+		if self.__props is EMPTY_ATTRS:
+			self.__props = {}
 		return self.__props
 	
-	@property
 	def set_attrs(self,**kwargs):
+		if len(kwargs) == 0:
+			return
+		if self.__props is EMPTY_ATTRS:
+			self.__props = {}
 		self.__props.update(kwargs)
 	
 class DataList(HDF5Group,DataLeaf):
+	__slots__ = ('__list','__props')
 	
 	def __init__(self,name,data,attrs={}):
 		self.set_name(name)
 		self.set_value(data)
-		self.__props = attrs
+		self.__props = EMPTY_ATTRS
+		self.set_attrs(**attrs)
 	
 	######### HDF5 Methods #################################################
 	
@@ -189,31 +247,28 @@ class DataList(HDF5Group,DataLeaf):
 		return attrs
 	
 	@classmethod
-	def _hdf5_populate(cls,hdfNode):
+	def _hdf5_populate(cls,h5file,hdfNode):
 		
 		found = {}
 		
-		for key,value in hdfNode._v_children.items():
-			extracted = populateDataType(dataObj=None,hdfNode=value,extractOnly=True)
-			#if isinstance(object,DataLeaf):
-			#	extracted['data'].set_attrs(**extracted['args'])
-			found[key] = extracted['data']
-			
+		for key,value in h5file.children(hdfNode):
+			obj,dtype = getPopulator(h5file,value)
+			extracted = obj._hdf5_populate(h5file,value)
+			args = dict(extracted['args'])
+			args.pop('type',None)
+			found[key] = getDataType(key,extracted['data'])
+			found[key].set_attrs(**args)
 		
 		final = []
-		for i in xrange(len(found)):
+		for i in range(len(found)):
 			final.append(found["index_"+str(i)])
 			
-		args = {}
-		for attr in hdfNode._v_attrs._f_list():
-			args[attr] = getattr(hdfNode._v_attrs,attr)
-		
-		return {'data':final,'args':args}
+		return {'data':final,'args':h5file.get_attrs(hdfNode)}
 	
 	######## DataLeaf #####################################################
 	@property
 	def value(self):
-		return map(lambda x: x.value if isinstance(x,DataLeaf) else x, self.__list)
+		return [x.value if isinstance(x,DataLeaf) else x for x in self.__list]
 	
 	def set_value(self,value):
 		self.__list = []
@@ -225,17 +280,25 @@ class DataList(HDF5Group,DataLeaf):
 	
 	@property
 	def attrs(self):
+		if self.__props is EMPTY_ATTRS:
+			self.__props = {}
 		return self.__props
 	
 	def set_attrs(self,**kwargs):
+		if len(kwargs) == 0:
+			return
+		if self.__props is EMPTY_ATTRS:
+			self.__props = {}
 		self.__props.update(kwargs)
 
 class DataArray(HDF5LeafArray,DataLeaf):
+	__slots__ = ('__data','__props')
 	
 	def __init__(self,name,data=None,attrs={}):
 		self.set_name(name)
-		self.__data = np.array(data)
-		self.__props = attrs
+		self.__data = data if isinstance(data,LeafSource) else np.array(data)
+		self.__props = EMPTY_ATTRS
+		self.set_attrs(**attrs)
 	
 	######### HDF5 Methods #################################################
 	
@@ -245,7 +308,7 @@ class DataArray(HDF5LeafArray,DataLeaf):
 	
 	@property
 	def _hdf5_leaf_array(self):
-		return self.__data
+		return self.value
 	
 	@property
 	def _hdf5_attrs(self):
@@ -254,17 +317,20 @@ class DataArray(HDF5LeafArray,DataLeaf):
 			attrs[prop] = self.__props[prop]
 		return attrs
 	
+	@property
+	def _hdf5_source(self):
+		return self.__data if isinstance(self.__data,LeafSource) else None
+	
 	@classmethod
-	def _hdf5_populate(cls,hdfNode):
-		args = {}
-		for attr in hdfNode._v_attrs._f_list():
-			args[attr] = getattr(hdfNode._v_attrs,attr)
-		return {'data':hdfNode.read(),'args':args}
+	def _hdf5_populate(cls,h5file,hdfNode):
+		return {'data':asTextValue(h5file.read(hdfNode)),'args':h5file.get_attrs(hdfNode)}
 	
 	######### Data Value Methods ###########################################
 	
 	@property
 	def value(self):
+		if isinstance(self.__data,LeafSource):
+			return self.__data.value
 		return self.__data
 	
 	def set_value(self,value):
@@ -272,7 +338,24 @@ class DataArray(HDF5LeafArray,DataLeaf):
 	
 	@property
 	def attrs(self):
+		if self.__props is EMPTY_ATTRS:
+			self.__props = {}
 		return self.__props
 	
 	def set_attrs(self,**kwargs):
+		if len(kwargs) == 0:
+			return
+		if self.__props is EMPTY_ATTRS:
+			self.__props = {}
 		self.__props.update(kwargs)
+
+#
+# The types whose values may be read lazily, from a `cache.LeafSource`
+LAZY_TYPES = (DataArray,DataDict)
+
+HDF5_TYPES = {
+	'storage': (Storage,'storage'),
+	'data_dict': (DataDict,'dict'),
+	'data_array': (DataArray,'array'),
+	'data_list': (DataList,'list'),
+}
@@ -0,0 +1,256 @@
+import hashlib
+import numpy as np
+
+from .compression import CHUNK_BYTES
+from .utility import RESERVED_ATTR_PREFIX, isReservedAttr, utf8Array, walk
+from . import backends
+
+#################### CONTENT DIGESTS ###########################################
+#
+# Arrays and tables may be written with a digest of their contents (see
+# `Storage.save`), and optionally with a digest of each block of `digest_rows`
+# rows (along their first axis); blocks are aligned with the chunks of arrays
+# written chunked. Digests are stored in the (reserved) attributes of each leaf
+# (`DIGEST_ATTRS`), and cover the bytes of the leaf as stored in the file, so
+# that two files, or a file and its digests, can be compared without reading
+# any data:
+#
+# >>> d.save('results.hdf5',digests='chunks')
+# >>> diff('results.hdf5','other.hdf5')
+# [<Difference at '/x' (data; rows 0-1024)>]
+# >>> verify('results.hdf5')
+# []
+#
+# `diff` compares the digests of leaves, reading only those leaves for which
+# either file has no digest (a block of rows at a time); `verify` reads every
+# leaf which has a digest, and checks it against its digests.
+
+DIGEST = RESERVED_ATTR_PREFIX + 'digest'
+DIGEST_ROWS = RESERVED_ATTR_PREFIX + 'digest_rows'
+DIGEST_CHUNKS = RESERVED_ATTR_PREFIX + 'digest_chunks'
+DIGEST_ATTRS = (DIGEST,DIGEST_ROWS,DIGEST_CHUNKS)
+
+# Chunk digests are stored in a single attribute, which HDF5 limits to 64KB
+# (less the rest of the leaf's header); they are kept to at most this size.
+MAX_CHUNK_DIGEST_BYTES = 32*1024
+
+# Leaves are read a block of about this many bytes at a time
+READ_BYTES = 32*1024**2
+
+#
+# Computes the digest of an array, and of each block of `rows` rows of it,
+# from the blocks (of any multiple of `rows` rows) passed to `update` in order.
+class Digester(object):
+
+	def __init__(self,algorithm,shape,dtype,rows=None):
+		self.algorithm = algorithm
+		self.rows = rows
+		self.digest = hashlib.new(algorithm,("%s %s" % (tuple(int(n) for n in shape),dtype.str)).encode('ascii'))
+		self.chunks = []
+
+	# Blocks are hashed through the buffer interface, without being copied
+	def update(self,block):
+		block = np.ascontiguousarray(block)
+		self.digest.update(block)
+		if self.rows is not None:
+			for start in range(0,max(len(block),1),self.rows):
+				self.chunks.append(np.frombuffer(hashlib.new(self.algorithm,block[start:start+self.rows]).digest(),dtype=np.uint8))
+
+	@property
+	def attrs(self):
+		attrs = {DIGEST:"%s:%s" % (self.algorithm,self.digest.hexdigest())}
+		if self.rows is not None:
+			attrs.update({DIGEST_ROWS:np.int64(self.rows),DIGEST_CHUNKS:np.array(self.chunks)})
+		return attrs
+
+class DigestPolicy(object):
+
+	def __init__(self,algorithm='sha256',chunks=False,max_chunks=1024):
+		hashlib.new(algorithm) # Fail early for unknown algorithms
+		self.algorithm = algorithm
+		self.chunks = chunks
+		self.max_chunks = max_chunks
+
+	def __repr__(self):
+		return "<DigestPolicy %s%s>" % (self.algorithm,", with chunks" if self.chunks else "")
+
+	#
+	# The digest attributes for `array`, which is written with chunks of shape
+	# `chunks` (if any). Blocks hold whole chunks, or about CHUNK_BYTES; and
+	# there are at most `max_chunks` of them, and no more than fit in
+	# MAX_CHUNK_DIGEST_BYTES, so that they fit in an attribute.
+	def attrs(self,array,chunks=None):
+		array = utf8Array(array)
+		if not self.chunks or array.ndim == 0:
+			digester = Digester(self.algorithm,array.shape,array.dtype)
+			digester.update(array)
+			return digester.attrs
+
+		step = chunks[0] if chunks else 1
+		rowBytes = max(array[:1].nbytes,1)
+		maxChunks = max(1,min(self.max_chunks,MAX_CHUNK_DIGEST_BYTES//hashlib.new(self.algorithm).digest_size))
+		rows = max(1,CHUNK_BYTES//(rowBytes*step),-(-len(array)//(maxChunks*step)))*step
+		digester = Digester(self.algorithm,array.shape,array.dtype,rows)
+		digester.update(array)
+		return digester.attrs
+
+#
+# Returns the policy for `digests`: None or False for none, True for leaf
+# digests only, 'chunks' for leaf and chunk digests, or a DigestPolicy
+def getPolicy(digests):
+	if digests is None or digests is False or isinstance(digests,DigestPolicy):
+		return digests or None
+	if digests is True:
+		return DigestPolicy()
+	if digests == 'chunks':
+		return DigestPolicy(chunks=True)
+	raise ValueError("Unknown digest option '%s'. Use True, 'chunks' or a DigestPolicy." % digests)
+
+######################### COMPARISON ###########################################
+
+class Difference(object):
+
+	def __init__(self,path,reason,rows=None):
+		self.path = path
+		self.reason = reason
+		self.rows = rows
+
+	def __repr__(self):
+		rows = "; rows %s" % ", ".join("%d-%d" % bounds for bounds in self.rows) if self.rows else ""
+		return "<Difference at '%s' (%s%s)>" % (self.path,self.reason,rows)
+
+	def __eq__(self,other):
+		return isinstance(other,Difference) and (self.path,self.reason,self.rows) == (other.path,other.reason,other.rows)
+
+	def __ne__(self,other):
+		return not self == other
+
+def sameValue(a,b):
+	if isinstance(a,np.ndarray) or isinstance(b,np.ndarray):
+		return np.array_equal(a,b)
+	return a == b
+
+def sameAttrs(a,b):
+	a = dict((k,v) for k,v in a.items() if not isReservedAttr(k))
+	b = dict((k,v) for k,v in b.items() if not isReservedAttr(k))
+	return set(a) == set(b) and all(sameValue(a[k],b[k]) for k in a)
+
+#
+# Compute the digests of a leaf in a file (with blocks of `rows` rows, if
+# given), reading it a block at a time.
+def leafDigests(h5file,node,algorithm,rows=None):
+	shape = tuple(node.shape)
+	if len(shape) == 0:
+		value = utf8Array(h5file.read(node))
+		digester = Digester(algorithm,shape,value.dtype,rows)
+		digester.update(value)
+		return digester
+
+	first = utf8Array(h5file.read_rows(node,0,1))
+	step = rows or 1
+	readRows = max(1,READ_BYTES//(max(first.nbytes,1)*step))*step
+	digester = Digester(algorithm,shape,first.dtype,rows)
+	for start in range(0,max(shape[0],1),readRows):
+		digester.update(utf8Array(h5file.read_rows(node,start,start+readRows)))
+	return digester
+
+#
+# The row ranges of the blocks whose digests differ
+def differentRows(chunksA,chunksB,rows,length):
+	return [(i*rows,min((i+1)*rows,length)) for i,(a,b) in enumerate(zip(chunksA,chunksB)) if not np.array_equal(a,b)]
+
+def algorithmOf(attrs):
+	return attrs[DIGEST].split(':')[0] if DIGEST in attrs else None
+
+#
+# Compare two leaves, by their digests if both have them (of the same kind),
+# or else by reading both.
+def compareLeaves(path,fileA,nodeA,attrsA,fileB,nodeB,attrsB):
+	if tuple(nodeA.shape) != tuple(nodeB.shape):
+		return Difference(path,'shape')
+	algorithm = algorithmOf(attrsA) or algorithmOf(attrsB) or 'sha256'
+	if algorithmOf(attrsA) == algorithmOf(attrsB) == algorithm:
+		digestA,digestB = attrsA,attrsB
+	else:
+		digestA = leafDigests(fileA,nodeA,algorithm).attrs if algorithmOf(attrsA) != algorithm else attrsA
+		digestB = leafDigests(fileB,nodeB,algorithm).attrs if algorithmOf(attrsB) != algorithm else attrsB
+	if digestA[DIGEST] == digestB[DIGEST]:
+		return None
+
+	rows = None
+	if DIGEST_CHUNKS in attrsA and DIGEST_CHUNKS in attrsB and attrsA[DIGEST_ROWS] == attrsB[DIGEST_ROWS]:
+		rows = differentRows(attrsA[DIGEST_CHUNKS],attrsB[DIGEST_CHUNKS],int(attrsA[DIGEST_ROWS]),nodeA.shape[0])
+	return Difference(path,'data',rows or None)
+
+#
+# Compare two files, returning the Differences between them: nodes found in only
+# one file ('only in a' or 'only in b'), nodes which are a group in one and a
+# leaf in the other ('type'), and nodes which differ in their attributes
+# ('attrs') or data ('shape', or 'data' with the rows which differ, if known).
+def diff(path_a,path_b,backend=None):
+	fileA = backends.openFile(path_a,mode='r',backend=backend)
+	try:
+		fileB = backends.openFile(path_b,mode='r',backend=backend)
+		try:
+			return compareFiles(fileA,fileB)
+		finally:
+			fileB.close()
+	finally:
+		fileA.close()
+
+def compareFiles(fileA,fileB):
+	differences = []
+	def visit(item):
+		path,nodeA,nodeB = item
+		attrsA,attrsB = fileA.get_attrs(nodeA),fileB.get_attrs(nodeB)
+		if not sameAttrs(attrsA,attrsB):
+			differences.append(Difference(path or "/",'attrs'))
+		if not fileA.is_group(nodeA):
+			difference = compareLeaves(path,fileA,nodeA,attrsA,fileB,nodeB,attrsB)
+			if difference is not None:
+				differences.append(difference)
+			return
+
+		childrenA,childrenB = dict(fileA.children(nodeA)),dict(fileB.children(nodeB))
+		subnodes = []
+		for name in sorted(set(childrenA) | set(childrenB)):
+			childPath = path + "/" + name
+			if name not in childrenB:
+				differences.append(Difference(childPath,'only in a'))
+			elif name not in childrenA:
+				differences.append(Difference(childPath,'only in b'))
+			elif fileA.is_group(childrenA[name]) != fileB.is_group(childrenB[name]):
+				differences.append(Difference(childPath,'type'))
+			else:
+				subnodes.append( (childPath,childrenA[name],childrenB[name]) )
+		return subnodes
+	walk(("",fileA.root,fileB.root),visit)
+	return differences
+
+#
+# Check the leaves of a file against their digests, returning a Difference
+# ('corrupt', with the rows which are, if known) for each which does not match.
+# Leaves without digests are not checked.
+def verify(path,backend=None):
+	h5file = backends.openFile(path,mode='r',backend=backend)
+	try:
+		return verifyFile(h5file)
+	finally:
+		h5file.close()
+
+def verifyFile(h5file):
+	corrupt = []
+	def visit(item):
+		path,node = item
+		if h5file.is_group(node):
+			return [(path + "/" + name,child) for name,child in h5file.children(node)]
+		attrs = h5file.get_attrs(node)
+		if DIGEST not in attrs:
+			return
+		rows = int(attrs[DIGEST_ROWS]) if DIGEST_ROWS in attrs else None
+		digester = leafDigests(h5file,node,algorithmOf(attrs),rows)
+		if digester.attrs[DIGEST] != attrs[DIGEST]:
+			bad = differentRows(digester.chunks,attrs[DIGEST_CHUNKS],rows,node.shape[0]) if rows is not None else None
+			corrupt.append(Difference(path,'corrupt',bad or None))
+	walk(("",h5file.root),visit)
+	return corrupt
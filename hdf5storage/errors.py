@@ -20,5 +20,8 @@ class NoSuchLeafError(HDF5StorageError):
 class InvalidNodeNameError(HDF5StorageError):
 	pass
 
+class BackendError(HDF5StorageError):
+	pass
+
 class InaccessibleGroupNodeWarning(UserWarning):
-	pass
\ No newline at end of file
+	pass
@@ -1,11 +1,11 @@
 import types
-from abc import ABCMeta, abstractmethod, abstractproperty
-from utility import encodeNumbers
-import errors
+from abc import abstractmethod, abstractproperty
+from .utility import Abstract, NUMBER_TYPES, encodeNumbers, decodeNumbers, walk, isReservedAttr
+from . import errors
 ###################### FOUNDATIONAL HDF5 CLASSES ###############################
 
-class DataNode(object):
-	__metaclass__ = ABCMeta
+class DataNode(Abstract):
+	__slots__ = ('__name',)
 	
 	@property
 	def name(self):
@@ -15,42 +15,38 @@ class DataNode(object):
 		self.__name = name
 	
 	def node(self,node="",create=None,generator=None):
-		# If node is not the root level node for this data object, recurse down tree
 		if isinstance(node,str):
 			nodes = node.split('/')
 		elif isinstance(node,(list,tuple)):
-			nodes = list(node)
-		elif isinstance(node,(int,long,complex,float)):
+			nodes = node
+		elif isinstance(node,NUMBER_TYPES):
 			nodes = [node]
 		else:
 			raise errors.InvalidNodeError("'%s' is not a valid node identifier." % node)
 		
-		create = create if create is not None else self.attrs.get('auto_nodes',False)
-
-		# Remove empty node strings
-		while len(nodes) > 0 and nodes[0] == "":
-			nodes.pop(0)
-
-		# Resolve data node
-		if len(nodes) == 0:
-			return self
-		else:
+		# Resolve data node one level at a time; empty node strings are ignored
+		nodeObj = self
+		for name in nodes:
+			if name == "":
+				continue
+			name = decodeNumbers(name)
 			try:
-				nodeObj = self._node(nodes[0])
-			except errors.NoSuchNodeError as e:
-				if create:
-					if isinstance(generator,types.FunctionType):
-						nodeObj = generator(nodes[0])
-					else:
-						nodeObj = self._group_generate(nodes[0])
-					self._add_node(nodes[0],data=nodeObj)
+				child = nodeObj._node(name)
+			except errors.NoSuchNodeError:
+				if not (create if create is not None else nodeObj.attrs.get('auto_nodes',False)):
+					raise
+				if isinstance(generator,types.FunctionType):
+					child = generator(name)
 				else:
-					raise e
-			
-			if not isinstance(nodeObj,DataNode):
-				raise errors.InvalidNodeError("Cannot find a valid node with name: '%s'" % nodes[0])
+					child = nodeObj._group_generate(name)
+				nodeObj._add_node(name,data=child)
+				child = nodeObj._node(name)
 			
-			return nodeObj.node(nodes[1:],generator=generator)
+			if not isinstance(child,DataNode):
+				raise errors.InvalidNodeError("Cannot find a valid node with name: '%s'" % name)
+			nodeObj = child
+		
+		return nodeObj
 	
 	def node_attrs(self,node="/",attrs=None):
 		node = self.node(node)
@@ -61,6 +57,36 @@ class DataNode(object):
 	def add_node(self,name,parent="/",data=None,dtype=None,attrs={}):
 		parent = self.node(parent)
 		parent._add_node(name,data=data,dtype=dtype,attrs=attrs)
+	
+	#
+	# Add many leaves at once. `nodes` is a mapping (or sequence of pairs) from
+	# node paths (relative to `parent`) to data. Every name is checked, and all
+	# data converted, before any parent is resolved (or created, if `create` or
+	# 'auto_nodes' permits), and every parent is resolved before any leaf is
+	# added; so that a bad name or value leaves the tree unchanged. Paths are
+	# grouped by their parent so that each parent group is resolved only once,
+	# and then filled in a single batch.
+	def add_nodes(self,nodes,parent="/",create=None):
+		if hasattr(nodes,'items'):
+			nodes = nodes.items()
+		
+		batches = {}
+		order = []
+		for path,data in nodes:
+			if isinstance(path,str) and '/' in path:
+				path = [x for x in path.split('/') if x != ""]
+				prefix,name = tuple(self._node_name(x) for x in path[:-1]),self._node_name(path[-1])
+			else:
+				prefix,name = (),self._node_name(path)
+			if prefix not in batches:
+				batches[prefix] = []
+				order.append(prefix)
+			batches[prefix].append((name,self._node_data(name,data)))
+		
+		parent = self.node(parent)
+		parents = [parent.node(prefix,create=create) for prefix in order]
+		for group,prefix in zip(parents,order):
+			group._add_nodes(batches[prefix])
 
 	# TODO : Make sure node is non-empty
 	def pop_node(self,node="/"):
@@ -137,6 +163,9 @@ class DataNode(object):
 	def __len__(self):
 		return len(self.leaves)
 	
+	def update(self,data=(),**kwargs):
+		self.add_nodes(list(data.items() if hasattr(data,'items') else data) + list(kwargs.items()))
+	
 	def pop(self,key):
 		if key in self.leaves:
 			return self._pop_node(key)
@@ -154,7 +183,11 @@ class DataNode(object):
 	############# Expose groups as attributes ##############################
 	# Short hand methods
 	def __getattr__(self,name):
-		if name in self.groups or not name.startswith('_') and self.attrs.get('auto_nodes',False):
+		# Private names are never nodes; bail out early so that half-constructed
+		# objects (e.g. during copying) do not recurse through `self.groups`.
+		if name.startswith('_'):
+			raise AttributeError(name)
+		if name in self.groups or self.attrs.get('auto_nodes',False):
 			return self.node(name)
 		raise AttributeError
 
@@ -170,6 +203,19 @@ class DataNode(object):
 	def _add_node(self,name,data=None,dtype=None,attrs={}):
 		raise NotImplementedError("No way to add nodes to '%s' objects." % self.__class__.__name__)
 
+	#
+	# Check (and decode) a node name, and convert data for a node, on behalf of
+	# `add_nodes`; which then passes the results to `_add_nodes`.
+	def _node_name(self,name):
+		return name
+	
+	def _node_data(self,name,data):
+		return data
+	
+	def _add_nodes(self,nodes):
+		for name,data in nodes:
+			self._add_node(name,data=data)
+
 	def _pop_node(self,name):
 		raise NotImplementedError("No way to pop the nodes of '%s' objects." % self.__class__.__name__)
 
@@ -182,11 +228,10 @@ class DataNode(object):
 		pass
 
 class DataGroup(DataNode):
-	
-	pass
+	__slots__ = ()
 
 class DataLeaf(DataNode):
-	__metaclass__ = ABCMeta
+	__slots__ = ()
 	
 	@abstractproperty
 	def value(self):
@@ -199,8 +244,12 @@ class DataLeaf(DataNode):
 	def append(self,value):
 		raise NotImplementedError
 
-class HDF5Node(object):
-	__metaclass__ = ABCMeta
+#
+# HDF5Node objects are written to, and restored from, HDF5 files through a
+# `backends.Backend` object (`h5file` below); `node` and `hdfNode` are the
+# group and dataset objects of that backend.
+class HDF5Node(Abstract):
+	__slots__ = ()
 	
 	#
 	# Returns the name to be used for this object's node
@@ -225,7 +274,7 @@ class HDF5Node(object):
 		return {}
 	
 	@abstractmethod
-	def _hdf5_populate(cls,hdfNode):
+	def _hdf5_populate(cls,h5file,hdfNode):
 		pass
 	
 	@abstractmethod
@@ -233,7 +282,7 @@ class HDF5Node(object):
 		raise NotImplementedError
 
 class HDF5Group(HDF5Node):
-	__metaclass__ = ABCMeta
+	__slots__ = ()
 	
 	#
 	# Returns a series of HDF5Node inheritance objects
@@ -242,56 +291,69 @@ class HDF5Group(HDF5Node):
 		return []
 	
 	#
-	# Write this node to an HDF5 file
-	def _hdf5_write(self,h5file,node):
-		
-		# Set node attributes
-		for attribute,value in self._hdf5_attrs.items():
-			node._f_setAttr(attribute,value)
-		
-		# Create subgroups
+	# Write this node, and all nodes beneath it, to an HDF5 file. Groups whose
+	# ids are keys of `links` are not written, but linked to the file named by
+	# the corresponding value (see `Storage.save_shards`).
+	def _hdf5_write(self,h5file,node,links=None):
+		h5file.set_attrs(node,self._hdf5_attrs)
+		walk((self,node),lambda item: item[0]._hdf5_write_group(h5file,item[1],links))
+	
+	#
+	# Write the leaves of this group, and create its subgroups (with their
+	# attributes); returning (group,subgroup node) pairs for the subgroups yet to
+	# be written.
+	def _hdf5_write_group(self,h5file,node,links=None):
+		subgroups = []
 		for child in self._hdf5_group_children:
-			if isinstance(child,HDF5Group):
-				subgroup = h5file.createGroup(node,child._hdf5_name,child._hdf5_desc)
-				child._hdf5_write(h5file, subgroup)
+			if links is not None and id(child) in links:
+				h5file.create_external_link(node,child._hdf5_name,links[id(child)])
+			elif isinstance(child,HDF5Group):
+				subgroups.append( (child,h5file.create_group(node,child._hdf5_name,child._hdf5_desc,child._hdf5_attrs)) )
 			else:
 				child._hdf5_write(h5file, node)
+		return subgroups
 
 class HDF5Leaf(HDF5Node):
-	__metaclass__ = ABCMeta
-	
-	def _hdf5_leaf_write_attrs(self,leafObject):
-		for attribute,value in self._hdf5_attrs.items():
-			leafObject._f_setAttr(attribute,value)
+	__slots__ = ()
 
 class HDF5LeafTable(HDF5Leaf):
-	__metaclass__ = ABCMeta
-	
-	@abstractproperty
-	def _hdf5_leaf_table_structure(self):
-		return NotImplementedError
+	__slots__ = ()
 	
+	#
+	# Returns the rows of the table as a numpy structured array
 	@abstractproperty
 	def _hdf5_leaf_table_entries(self):
 		return []
 	
+	#
+	# Tables are written with digests as chosen by the file's digest policy, if
+	# any (see `HDF5LeafArray._hdf5_write`).
 	def _hdf5_write(self,h5file,group):
-		table = h5file.createTable(group, self._hdf5_name, self._hdf5_leaf_table_structure, self._hdf5_desc)
-		#Actually write table
-		entryDetails = table.row
-		for entry in self._hdf5_leaf_table_entries:
-			for key in entry:
-				entryDetails[key] = entry[key]
-			entryDetails.append()
-		table.flush()
-		self._hdf5_leaf_write_attrs(table)
+		entries = self._hdf5_leaf_table_entries
+		attrs = dict((attr,value) for attr,value in self._hdf5_attrs.items() if not isReservedAttr(attr))
+		if h5file.digests is not None:
+			attrs.update(h5file.digests.attrs(entries))
+		h5file.create_table(group, self._hdf5_name, entries, self._hdf5_desc, attrs)
 
 class HDF5LeafArray(HDF5Leaf):
-	__metaclass__ = ABCMeta
+	__slots__ = ()
 	
 	@abstractproperty
 	def _hdf5_leaf_array(self):
 		return []
 	
+	#
+	# Arrays are compressed as chosen by the file's compression policy, if any;
+	# the choice is recorded in the reserved attrs (see
+	# `utility.RESERVED_ATTR_PREFIX`), replacing any earlier choice. Likewise
+	# for digests of the array's contents, and the digest policy.
 	def _hdf5_write(self,h5file,group):
-		self._hdf5_leaf_write_attrs(h5file.createArray(group,self._hdf5_name, self._hdf5_leaf_array, self._hdf5_desc))
+		array = self._hdf5_leaf_array
+		attrs = dict((attr,value) for attr,value in self._hdf5_attrs.items() if not isReservedAttr(attr))
+		
+		choice = h5file.compression.select(array) if h5file.compression is not None else None
+		if choice is not None:
+			attrs.update(choice.attrs)
+		if h5file.digests is not None:
+			attrs.update(h5file.digests.attrs(array,choice.chunks if choice is not None and choice.compressed else None))
+		h5file.create_array(group, self._hdf5_name, array, self._hdf5_desc, attrs, filters=choice if choice is not None and choice.compressed else None)
@@ -0,0 +1,64 @@
+import numpy as np
+
+from .interfaces import HDF5LeafArray
+from .utility import encodeNumbers
+from . import errors, backends
+
+#################### LIVE MONITORING ###########################################
+#
+# A Storage object may be written to a file which is then appended to while it
+# is being read, using HDF5's single-writer/multiple-reader (SWMR) mode (which
+# only the h5py backend supports). The structure of the file is fixed once the
+# writer is started: all groups, leaves and attributes must already be present
+# in the Storage object, and only arrays (along their first axis) may grow;
+# scalars, which have no axes, cannot.
+#
+# >>> writer = d.save_live('results.hdf5')
+# >>> writer.append('run/losses',[0.5,0.4])
+#
+# Readers load the file lazily, and refresh to see appended data:
+#
+# >>> d2 = Storage._load('results.hdf5',backend='h5py',lazy=True,swmr=True)
+# >>> d2.refresh()
+#
+# Appended data is written to the file only; the arrays of the Storage object
+# being written are left unchanged. SWMR requires the latest HDF5 file format,
+# which versions of PyTables built against HDF5 1.8 cannot read; such files are
+# best read with the h5py backend.
+
+class LiveWriter(object):
+
+	def __init__(self,storage,location,backend='h5py'):
+		self.__storage = storage
+		self.h5file = backends.openFile(location,mode='w',title=storage._hdf5_name,backend=backend,swmr=True)
+		try:
+			storage._hdf5_write(self.h5file,self.h5file.root)
+			self.h5file.start_swmr()
+		except:
+			self.h5file.close()
+			raise
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*exc_info):
+		self.close()
+
+	#
+	# Append `values` to the array at node path `path`, and flush them to the
+	# file, so that readers see them on their next refresh.
+	def append(self,path,values):
+		leaf = self.__storage.node(path)
+		if not isinstance(leaf,HDF5LeafArray):
+			raise errors.InvalidNodeError("Only arrays can be appended to; '%s' is not an array." % path)
+		if np.ndim(leaf.value) == 0:
+			raise errors.InvalidNodeError("Scalars cannot be appended to; '%s' is a scalar." % path)
+		if isinstance(path,str):
+			path = path.split('/')
+		self.h5file.append(self.h5file.get_node("/" + "/".join(encodeNumbers(name) for name in path if name != "")),values)
+
+	def flush(self):
+		self.h5file.flush()
+
+	def close(self):
+		self.h5file.close()
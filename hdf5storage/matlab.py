@@ -0,0 +1,390 @@
+import re, sys, time, tempfile, zlib
+import numpy as np
+
+from .interfaces import DataGroup
+from .utility import encodeNumbers, walk
+from . import errors
+
+#################### MATLAB EXPORT #############################################
+#
+# Storage objects are exported to a single MAT file, in which groups (and
+# dictionaries) become nested structs, and lists become cell arrays. Version 5
+# files are written with scipy's variable writer, and version 7.3 (HDF5 based)
+# files with h5py; both one leaf at a time, so that the tree never needs to be
+# copied into memory as a whole (except with scipy versions whose writer is not
+# known to support this; see `Mat5Private`).
+
+MAT_NAME_LENGTH = 63
+MAT_NAME_INVALID = re.compile("[^A-Za-z0-9_]")
+
+#
+# Variable and field names in MATLAB must be identifiers; so numeric names are
+# encoded (as in HDF5 files) and any other characters replaced by underscores.
+def matName(name):
+	name = MAT_NAME_INVALID.sub('_',encodeNumbers(name))
+	if not name[:1].isalpha():
+		name = 'x' + name
+	return name[:MAT_NAME_LENGTH]
+
+#
+# Returns the MAT names of `names` (the children of a group, or the keys of a
+# dictionary), as (MAT name,name) pairs; names which would be written as the
+# same MAT name are rejected, rather than written over one another.
+def matNames(names):
+	found = {}
+	pairs = []
+	for name in names:
+		mat = matName(name)
+		if mat in found:
+			raise errors.InvalidNodeNameError("The names '%s' and '%s' would both be written as '%s' to the MAT file." % (found[mat],name,mat))
+		found[mat] = name
+		pairs.append( (mat,name) )
+	return pairs
+
+#
+# Returns the (MAT name,child) pairs of a group
+def children(group):
+	return [(mat,group._node(name)) for mat,name in matNames(group.nodes)]
+
+def saveMat(storage,location,version='5',do_compression=True):
+	if str(version) == '5':
+		saveMat5(storage,location,do_compression=do_compression)
+	elif str(version) == '7.3':
+		saveMat73(storage,location,do_compression=do_compression)
+	else:
+		raise ValueError("Unsupported MAT file version '%s'. Use '5' or '7.3'." % version)
+
+######################### VERSION 5 (scipy) ####################################
+
+#
+# Convert a value into something scipy.io.savemat understands
+def mat5Value(value):
+	if isinstance(value,DataGroup):
+		return mat5Struct(value)
+	if isinstance(value,dict):
+		return dict((mat,mat5Value(value[key])) for mat,key in matNames(value.keys()))
+	if isinstance(value,list):
+		cell = np.empty((1,len(value)),dtype=object)
+		for i,item in enumerate(value):
+			cell[0,i] = mat5Value(item)
+		return cell
+	return value
+
+#
+# Convert a group into a (nested) dictionary, which scipy writes as a struct;
+# for groups held in leaf values (e.g. in lists), which are in memory anyway.
+def mat5Struct(group):
+	struct = {}
+	def visit(item):
+		group,struct = item
+		subgroups = []
+		for name,child in children(group):
+			if isinstance(child,DataGroup):
+				struct[name] = {}
+				subgroups.append( (child,struct[name]) )
+			else:
+				struct[name] = mat5Value(child.value)
+		return subgroups
+	walk((group,struct),visit)
+	return struct
+
+#
+# Streaming variables to a version 5 file relies on parts of scipy's private
+# MAT 5 writer (in `scipy.io.matlab._mio5`, or `mio5` before scipy 1.8), all of
+# which are used through this adapter. They are known to work with the scipy
+# versions between SCIPY_PRIVATE_VERSIONS (inclusive); with any other version,
+# or should any part be missing, `mat5Private` returns None and variables are
+# written with `scipy.io.savemat` instead (see `Mat5SaveMatWriter`).
+SCIPY_PRIVATE_VERSIONS = ((1,2),(1,17))
+
+class Mat5Private(object):
+
+	MODULE_NAMES = ('MatFile5Writer','VarWriter5','NDT_TAG_FULL','miCOMPRESSED','miINT8','mxSTRUCT_CLASS')
+	WRITER_NAMES = ('write','write_header','write_element','write_empty_struct','update_matrix_tag','file_stream','_var_name','_var_is_global')
+
+	def __init__(self,mio5):
+		self.mio5 = mio5
+
+	#
+	# Write the file header to `stream`, returning the variable writer
+	def writer(self,stream):
+		fileWriter = self.mio5.MatFile5Writer(stream,unicode_strings=True,long_field_names=True,oned_as='row')
+		fileWriter.write_file_header()
+		return self.mio5.VarWriter5(fileWriter)
+
+	# scipy names the next matrix written at the top level by these
+	def start_variable(self,writer,stream,name):
+		writer.file_stream = stream
+		writer._var_name,writer._var_is_global = name.encode('ascii'),False
+
+	def write_value(self,writer,value):
+		writer.write(value)
+
+	def write_empty_struct(self,writer,start):
+		writer.write_empty_struct()
+		writer.update_matrix_tag(start)
+
+	#
+	# Write the header of a struct with the fields `names`, whose values are
+	# to be written next, and then ended with `end_matrix`
+	def start_struct(self,writer,names):
+		writer.write_header((1,1),self.mio5.mxSTRUCT_CLASS)
+		length = max(len(name) for name in names) + 1
+		writer.write_element(np.array([length],dtype='i4'))
+		writer.write_element(np.array(names,dtype='S%d' % length),mdtype=self.mio5.miINT8)
+
+	def end_matrix(self,writer,start):
+		writer.update_matrix_tag(start)
+
+	def compressed_tag(self):
+		tag = np.zeros((),self.mio5.NDT_TAG_FULL)
+		tag['mdtype'] = self.mio5.miCOMPRESSED
+		return tag
+
+def scipyVersion(scipy):
+	return tuple(int(part) for part in re.findall(r"\d+",scipy.__version__)[:2])
+
+def mat5Private():
+	import io, scipy
+	if not SCIPY_PRIVATE_VERSIONS[0] <= scipyVersion(scipy) <= SCIPY_PRIVATE_VERSIONS[1]:
+		return None
+	try:
+		from scipy.io.matlab import _mio5 as mio5
+	except ImportError:
+		try:
+			from scipy.io.matlab import mio5
+		except ImportError:
+			return None
+	if not all(hasattr(mio5,name) for name in Mat5Private.MODULE_NAMES):
+		return None
+	try:
+		writer = Mat5Private(mio5).writer(io.BytesIO())
+	except Exception:
+		return None
+	if not all(hasattr(writer,name) for name in Mat5Private.WRITER_NAMES):
+		return None
+	return Mat5Private(mio5)
+
+#
+# Writes groups to a version 5 file as structs, a field at a time, with scipy's
+# writer for the leaves. Every matrix in a version 5 file starts with its size,
+# which is filled in once its contents have been written; so compressed
+# variables (which are compressed as a whole) are first written to a temporary
+# file, rather than to memory as scipy does.
+class Mat5Writer(object):
+
+	COPY_BYTES = 1024**2
+
+	def __init__(self,stream,private,do_compression=True):
+		self.private = private
+		self.stream = stream
+		self.do_compression = do_compression
+		self.writer = private.writer(stream)
+
+	def put_variable(self,name,value):
+		if not self.do_compression:
+			return self.write(self.stream,name,value)
+		buffer = tempfile.TemporaryFile()
+		try:
+			self.write(buffer,name,value)
+			buffer.seek(0)
+			self.compress(buffer)
+		finally:
+			buffer.close()
+
+	#
+	# Copy `buffer` to the file as a compressed element
+	def compress(self,buffer):
+		tag = self.private.compressed_tag()
+		start = self.stream.tell()
+		self.stream.write(tag.tobytes())
+		compressor = zlib.compressobj()
+		for block in iter(lambda: buffer.read(self.COPY_BYTES),b''):
+			self.stream.write(compressor.compress(block))
+		self.stream.write(compressor.flush())
+		end = self.stream.tell()
+		if end-start-8 >= 2**32:
+			raise ValueError("The variable is too large for a version 5 MAT file; use version '7.3'.")
+		tag['byte_count'] = end-start-8
+		self.stream.seek(start)
+		self.stream.write(tag.tobytes())
+		self.stream.seek(end)
+
+	#
+	# Write a top-level variable to `stream`. Items are ('group',group),
+	# ('leaf',leaf), or ('end',position) once the fields of the struct starting
+	# at `position` have been written.
+	def write(self,stream,name,value):
+		private,writer = self.private,self.writer
+		private.start_variable(writer,stream,name)
+		def visit(item):
+			kind,node = item
+			if kind == 'end':
+				private.end_matrix(writer,node)
+				return
+			if kind == 'leaf':
+				private.write_value(writer,mat5Value(node.value))
+				return
+			start = stream.tell()
+			fields = children(node)
+			if len(fields) == 0:
+				private.write_empty_struct(writer,start)
+				return
+			private.start_struct(writer,[field for field,child in fields])
+			return [('group' if isinstance(child,DataGroup) else 'leaf',child) for field,child in fields] + [('end',start)]
+		walk(('group' if isinstance(value,DataGroup) else 'leaf',value),visit)
+
+#
+# Writes each top-level variable with `scipy.io.savemat`, in memory as a whole,
+# and appends it to the file (without the header savemat writes first).
+class Mat5SaveMatWriter(object):
+
+	HEADER_BYTES = 128
+
+	def __init__(self,stream,do_compression=True):
+		import scipy.io
+		self.savemat = scipy.io.savemat
+		self.stream = stream
+		self.do_compression = do_compression
+		self.stream.write(self.variable_bytes({})[:self.HEADER_BYTES])
+
+	def variable_bytes(self,variables):
+		import io
+		buffer = io.BytesIO()
+		self.savemat(buffer,variables,do_compression=self.do_compression,long_field_names=True,oned_as='row')
+		return buffer.getvalue()
+
+	def put_variable(self,name,value):
+		value = mat5Struct(value) if isinstance(value,DataGroup) else mat5Value(value.value)
+		self.stream.write(self.variable_bytes({name:value})[self.HEADER_BYTES:])
+
+def saveMat5(storage,location,do_compression=True):
+	private = mat5Private()
+	with open(location,'wb') as stream:
+		if private is not None:
+			writer = Mat5Writer(stream,private,do_compression=do_compression)
+		else:
+			writer = Mat5SaveMatWriter(stream,do_compression=do_compression)
+		for name,child in children(storage):
+			writer.put_variable(name,child)
+
+######################### VERSION 7.3 (h5py) ###################################
+
+MAT_CLASSES = {
+	'f8':'double', 'f4':'single',
+	'i1':'int8', 'i2':'int16', 'i4':'int32', 'i8':'int64',
+	'u1':'uint8', 'u2':'uint16', 'u4':'uint32', 'u8':'uint64',
+}
+
+class Mat73Writer(object):
+
+	USERBLOCK_SIZE = 512
+
+	def __init__(self,location,do_compression=True):
+		try:
+			import h5py
+		except ImportError:
+			raise errors.BackendError("Writing MAT 7.3 files requires the h5py package to be installed.")
+		self.h5py = h5py
+		self.location = location
+		self.compression = 'gzip' if do_compression else None
+		self.h5file = h5py.File(location,'w',userblock_size=self.USERBLOCK_SIZE)
+		self.refs = None
+
+	def close(self):
+		self.h5file.close()
+		header = 'MATLAB 7.3 MAT-file, Platform: %s, Created on: %s HDF5 schema 1.00 .' % (sys.platform,time.strftime('%a %b %d %H:%M:%S %Y'))
+		with open(self.location,'r+b') as stream:
+			stream.write(header.ljust(116).encode('ascii') + b'\0'*8 + b'\x00\x02' + b'IM')
+
+	def __dataset(self,parent,name,data,cls,**attrs):
+		compression = self.compression if data.size > 1 else None
+		dataset = parent.create_dataset(name,data=data,compression=compression)
+		dataset.attrs['MATLAB_class'] = np.bytes_(cls)
+		for attr,value in attrs.items():
+			dataset.attrs[attr] = value
+		return dataset
+
+	def struct(self,parent,name):
+		group = parent.create_group(name)
+		group.attrs['MATLAB_class'] = np.bytes_('struct')
+		return group
+
+	#
+	# Write a leaf value. Dictionaries and lists are written in full here, and
+	# arrays are transposed, since MATLAB stores them in column-major order.
+	def write(self,parent,name,value):
+		if isinstance(value,DataGroup):
+			return self.write_group(parent,name,value)
+		if isinstance(value,dict):
+			group = self.struct(parent,name)
+			for mat,key in matNames(value.keys()):
+				self.write(group,mat,value[key])
+			return group
+		if isinstance(value,list):
+			return self.write_cell(parent,name,value)
+
+		value = np.asarray(value)
+		if value.dtype.kind in 'SU':
+			if value.ndim > 0:
+				return self.write_cell(parent,name,value.tolist())
+			text = value.item()
+			text = text if isinstance(text,type(u'')) else text.decode('utf-8')
+			codes = np.array([ord(c) for c in text],dtype=np.uint16).reshape(1,-1)
+			if codes.size == 0:
+				return self.__dataset(parent,name,np.array([0,0],dtype=np.uint64),'char',MATLAB_empty=np.uint8(1),MATLAB_int_decode=np.int32(2))
+			return self.__dataset(parent,name,codes.T,'char',MATLAB_int_decode=np.int32(2))
+
+		if value.dtype.kind == 'b':
+			cls,value,attrs = 'logical',value.astype(np.uint8),{'MATLAB_int_decode':np.int32(1)}
+		elif value.dtype.kind == 'c':
+			part = value.real.dtype
+			cls,attrs = MAT_CLASSES[part.str[1:]],{}
+			complexValue = np.empty(value.shape,dtype=[('real',part),('imag',part)])
+			complexValue['real'],complexValue['imag'] = value.real,value.imag
+			value = complexValue
+		elif value.dtype.str[1:] in MAT_CLASSES:
+			cls,attrs = MAT_CLASSES[value.dtype.str[1:]],{}
+		else:
+			raise ValueError("Cannot write '%s' of type %s to a MAT file." % (name,value.dtype))
+
+		value = np.atleast_2d(value)
+		if value.size == 0:
+			attrs['MATLAB_empty'] = np.uint8(1)
+			return self.__dataset(parent,name,np.array(value.shape[::-1],dtype=np.uint64),cls,**attrs)
+		return self.__dataset(parent,name,value.T,cls,**attrs)
+
+	#
+	# Cells hold references to their elements, which are stored in '#refs#'
+	def write_cell(self,parent,name,values):
+		if self.refs is None:
+			self.refs = self.h5file.create_group('#refs#')
+		refs = np.empty((len(values),1),dtype=self.h5py.special_dtype(ref=self.h5py.Reference))
+		for i,item in enumerate(values):
+			refName = 'r%d' % len(self.refs)
+			self.write(self.refs,refName,item)
+			refs[i,0] = self.refs[refName].ref
+		return self.__dataset(parent,name,refs,'cell')
+
+	#
+	# Write a group as a struct, leaf by leaf
+	def write_group(self,parent,name,group):
+		def visit(item):
+			group,h5group = item
+			subgroups = []
+			for name,child in children(group):
+				if isinstance(child,DataGroup):
+					subgroups.append( (child,self.struct(h5group,name)) )
+				else:
+					self.write(h5group,name,child.value)
+			return subgroups
+		h5group = self.struct(parent,name) if name is not None else parent
+		walk((group,h5group),visit)
+		return h5group
+
+def saveMat73(storage,location,do_compression=True):
+	writer = Mat73Writer(location,do_compression=do_compression)
+	try:
+		writer.write_group(writer.h5file,None,storage)
+	finally:
+		writer.close()
@@ -1,31 +1,125 @@
-import re
+import re, functools
+from abc import ABCMeta
 
+import numpy as np
+
+#
+# Python 2 and 3 differ in their integer types, and in how metaclasses are
+# declared; classes derived from `Abstract` have ABCMeta as theirs under both.
+try:
+	INTEGER_TYPES = (int,long)
+except NameError:
+	INTEGER_TYPES = (int,)
+	long = int
+
+NUMBER_TYPES = INTEGER_TYPES + (float,complex)
+
+try:
+	TEXT_TYPES = (str,unicode)
+except NameError:
+	TEXT_TYPES = (str,)
+
+Abstract = ABCMeta('Abstract',(object,),{'__slots__':()})
+
+#
+# Text is stored as UTF-8 bytes, in arrays and tables, attributes and digests
+# alike; every value is encoded with this function before it is written, so
+# that all of these agree on its bytes.
+def utf8Array(values):
+	values = np.asarray(values)
+	if values.dtype.kind == 'U':
+		values = np.char.encode(values,'utf-8')
+	return values
+
+#
+# Attributes whose names start with this prefix are reserved for those written
+# by this package itself (e.g. the compression chosen for an array), which
+# describe how a leaf is stored; they are replaced whenever it is written.
+RESERVED_ATTR_PREFIX = 'hdf5storage_'
+
+def isReservedAttr(name):
+	return name.startswith(RESERVED_ATTR_PREFIX)
+
+#
+# A read-only dictionary shared by all nodes without attributes of their own.
+# Nodes swap it for a private dictionary the first time `set_attrs` is called,
+# so that millions of leaves do not each carry an empty dictionary.
+class FrozenAttributes(dict):
+	__slots__ = ()
+	
+	def __readonly(self,*args,**kwargs):
+		raise TypeError("Node attributes are read-only here; use `set_attrs` instead.")
+	
+	__setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __readonly
+	
+	# Unpickle as the shared instance, so that `set_attrs` still recognises it
+	def __reduce__(self):
+		return 'EMPTY_ATTRS'
+
+EMPTY_ATTRS = FrozenAttributes()
+
+#
+# Encoded numbers look like 'float(2.5)'; other names, including those with
+# brackets (e.g. 'f(x)'), are never decoded.
+NUMBER_PATTERN = re.compile(r"^(long|int|float|complex)\(([\w\(\)\+\-\.]*)\)$")
+NUMBER_PARSERS = {'long':long,'int':int,'float':float,'complex':complex}
+
+#
+# Node names recur heavily (e.g. `index_<n>` in every list), so the results of
+# encoding and decoding names are remembered. The type is part of the cache key
+# since 1, 1.0 and True all compare (and hash) equal.
+NAME_CACHE_SIZE = 65536
+
+def cachedByType(f):
+	cache = {}
+	@functools.wraps(f)
+	def cached(name):
+		key = (type(name),name)
+		try:
+			return cache[key]
+		except KeyError:
+			pass
+		except TypeError: # Unhashable; let f decide what to do with it
+			return f(name)
+		if len(cache) >= NAME_CACHE_SIZE:
+			cache.clear()
+		value = cache[key] = f(name)
+		return value
+	return cached
+
+@cachedByType
 def encodeNumbers(name):
 	if isinstance(name,str):
 		return name
-	elif isinstance(name,(int,long)):
+	elif isinstance(name,INTEGER_TYPES):
 		return "long(%d)" % name
 	elif isinstance(name,float):
 		return "float(%.17e)"%name
 	elif isinstance(name,complex):
-		return "complex(({0.real:.17e}{0.imag:+.17e}j))"%name
+		return "complex(({0.real:.17e}{0.imag:+.17e}j))".format(name)
 	raise ValueError("'%s' of type %s is not recognised."%(name,type(name)))
 
+@cachedByType
 def decodeNumbers(name):
-	if isinstance(name,(int,long,float,complex)):
+	if isinstance(name,NUMBER_TYPES):
 		return name
-	m = re.match("^([a-zA-Z]+)\(([\w\(\)\+\-\.]*)\)$",name)
+	m = NUMBER_PATTERN.match(name)
 	if m is None:
 		return name
 	numtype,numstr = m.groups()
-	if numtype == 'long':
-		return long(numstr)
-	elif numtype == 'int':
-		return int(numstr)
-	elif numtype == 'float':
-		return float(numstr)
-	elif numtype == 'complex':
-		return complex(numstr)
-	raise ValueError("'%s' of type %s is not recognised."%(name,type(name)))
-	
-	
+	try:
+		return NUMBER_PARSERS[numtype](numstr)
+	except ValueError: # e.g. 'float(x)', which only looks like a number
+		return name
+
+#
+# Walk a tree depth first using an explicit stack, so that the depth of a tree
+# is not bounded by Python's recursion limit. `visit(item)` processes an item
+# and returns the items for its children (if any), which are then visited in
+# order before the siblings of `item`.
+def walk(root,visit):
+	stack = [root]
+	while len(stack) > 0:
+		children = visit(stack.pop())
+		if children:
+			stack.extend(reversed(children))
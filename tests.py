@@ -1,5 +1,5 @@
 import unittest
-from hdf5storage import Storage
+from hdf5storage import Storage, errors
 import numpy as np
 
 class TestUnitNewCreation(unittest.TestCase):
@@ -24,38 +24,325 @@ class TestUnitNewCreation(unittest.TestCase):
 	
 	def test_autonodes(self):
 		d = Storage('Test',attrs={'auto_nodes':True})
-		self.assertEquals( isinstance(d.x.y.u.asdasdasd,Storage), True)
+		self.assertEqual( isinstance(d.x.y.u.asdasdasd,Storage), True)
 	
 	def test_dict_like(self):
 		self.d['x'] = 1
 		self.d[2.5] = 2
 		self.d[2.124] = 2
 		self.d[80.0127665245] = 3
-		self.assertEquals(self.d[80.0127665245],3)
-		self.assertEquals(set(self.d),set(['x',2.5,2.124,80.0127665245]))
-		self.assertEquals(len(self.d),4)
+		self.assertEqual(self.d[80.0127665245],3)
+		self.assertEqual(set(self.d),set(['x',2.5,2.124,80.0127665245]))
+		self.assertEqual(len(self.d),4)
 		self.d>>'test.hdf5'
 		
 		d = Storage._load('test.hdf5')
-		self.assertEquals(set(d),set(['x',2.5,2.124,80.0127665245]))
-		self.assertEquals(len(d),4)
+		self.assertEqual(set(d),set(['x',2.5,2.124,80.0127665245]))
+		self.assertEqual(len(d),4)
 		
 		d.pop('x')
-		self.assertEquals(set(d),set([2.5,2.124,80.0127665245]))
-		self.assertEquals(len(d),3)
+		self.assertEqual(set(d),set([2.5,2.124,80.0127665245]))
+		self.assertEqual(len(d),3)
+
+	def test_update(self):
+		self.d.set_attrs(auto_nodes=True)
+		self.d.update({'x':1, 2.5:2, 'a/b/c':np.array([1,2]), 'a/b/d':'d'},e=3)
+		self.assertEqual(set(self.d),set(['x',2.5,'e']))
+		self.assertEqual(set(self.d.a.b),set(['c','d']))
+		self.assertEqual(self.d.a.b['c'].tolist(),[1,2])
+		
+		self.d.add_nodes([('p/q',1)],parent='x2',create=True)
+		self.assertEqual(self.d.node('x2/p')['q'],1)
+		
+		self.assertRaises(errors.InvalidNodeNameError,self.d.update,{'y':1,'_bad':2})
+		self.assertFalse('y' in self.d.keys())
+		self.assertRaises(errors.InvalidNodeNameError,self.d.update,{'m/n':1,'p/q/_bad':2},z=3)
+		self.assertEqual((self.d.nodes.count('m'),self.d.nodes.count('p'),self.d.nodes.count('z')),(0,0,0))
+
+	def test_deep_tree(self):
+		path = '/'.join('n%d'%i for i in range(2000))
+		self.d.node(path,create=True)['leaf'] = 1
+		self.assertEqual(self.d.node(path)['leaf'],1)
+		self.assertEqual(len(self.d.structure().split('\n')),2002)
+		
+		import sys
+		d = Storage('Deep')
+		path = '/'.join('n%d'%i for i in range(sys.getrecursionlimit()+100))
+		d.node(path,create=True)['leaf'] = np.array([1,2])
+		# PyTables opens each group by its full path, which makes loading such
+		# deep trees quadratic in their depth; h5py does not.
+		d.save('output.hdf5',backend='h5py')
+		d2 = Storage._load('output.hdf5',backend='h5py')
+		self.assertEqual(d2.node(path)['leaf'].tolist(),[1,2])
+		
+		self.d.node(2.5,create=True)
+		self.assertTrue(self.d.node('float(2.5)') is self.d.node(2.5))
+		self.assertRaises(errors.NoSuchNodeError,self.d.node,'f(x)')
+		self.assertRaises(errors.InvalidNodeNameError,self.d.node,'float(x)',True)
+
+	def test_backends(self):
+		self.d['a'] = np.arange(3)
+		self.d['flags'] = np.array([True,False])
+		self.d['dict'] = {'x':1}
+		self.d.node('g',create=True)['list'] = [1,2]
+		self.d.node_attrs('a',{'flag':True,'n':2})
+		for write in ['pytables','h5py']:
+			for read in ['pytables','h5py']:
+				self.d.save('output.hdf5',backend=write)
+				d2 = Storage._load('output.hdf5',backend=read)
+				self.assertEqual(d2['a'].tolist(),[0,1,2])
+				self.assertEqual(d2['flags'].tolist(),[True,False])
+				self.assertEqual(d2['dict'],{'x':1})
+				self.assertEqual(d2.g['list'],[1,2])
+				self.assertEqual(d2.node_attrs('a'),{'type':'data_array','flag':True,'n':2})
+		self.assertRaises(errors.BackendError,self.d.save,'output.hdf5',backend='nonexistent')
+		
+		# Attributes which are not numpy values are pickled, as PyTables does
+		attrs = {'labels':['x','y'],'note':None,'empty':'','text':'done.','meta':{'k':1},'mixed':[1,'a']}
+		self.d.node_attrs('g',dict(attrs,cells=np.array([None,1],dtype=object)))
+		for write in ['pytables','h5py']:
+			self.d.save('output.hdf5',backend=write)
+			for read in ['pytables','h5py']:
+				loaded = Storage._load('output.hdf5',backend=read).node_attrs('g')
+				self.assertEqual(loaded.pop('cells').tolist(),[None,1])
+				self.assertEqual(loaded,dict(attrs,type='storage'))
+
+	def test_lazy(self):
+		from hdf5storage.cache import LeafCache
+		for i in range(3):
+			self.d['a%d'%i] = np.arange(1000)
+		self.d.node('g',create=True)['dict'] = {'x':1}
+		self.d >> 'output.hdf5'
+
+		cache = LeafCache(max_bytes=20000)
+		for backend in ['pytables','h5py']:
+			cache.clear()
+			cache.reset_stats()
+			d2 = Storage._load('output.hdf5',backend=backend,lazy=True,cache=cache)
+			self.assertEqual(len(cache),0)
+			self.assertEqual(d2['a0'].tolist(),list(range(1000)))
+			self.assertEqual(d2['a0'][5],5)
+			self.assertEqual(d2.g['dict'],{'x':1})
+			self.assertEqual(d2.node_attrs('a0'),{'type':'data_array'})
+			self.assertEqual((cache.hits,cache.misses),(1,2))
+			d2['a1'], d2['a2']
+			self.assertEqual(cache.evictions,1)
+			self.assertTrue(cache.nbytes <= 20000)
+			self.assertRaises(ValueError,d2['a1'].__setitem__,0,1)
+			self.assertRaises(TypeError,d2.g['dict'].__setitem__,'x',5)
+			self.assertRaises(TypeError,d2.g['dict'].update,{'y':5})
+			cache.clear()
+			self.assertEqual(d2.g['dict'],{'x':1})
+			d2.g.node('dict').set_value({'x':5})
+			cache.clear()
+			self.assertEqual(d2.g['dict'],{'x':5})
+			d2.g['dict']['x'] = 6
+			self.assertEqual(d2.g['dict'],{'x':6})
+
+			d2.save('output2.hdf5')
+			self.assertEqual(Storage._load('output2.hdf5')['a2'].tolist(),list(range(1000)))
+			
+			import copy, pickle
+			d3 = copy.deepcopy(d2)
+			self.assertEqual(d3['a0'].tolist(),list(range(1000)))
+			d4 = pickle.loads(pickle.dumps(d2,2))
+			self.assertEqual(d4['a1'].tolist(),list(range(1000)))
+			self.assertEqual(d4.g['dict'],{'x':6})
+			d2.save_shards('output2.hdf5',processes=2)
+			self.assertEqual(Storage._load('output2.hdf5').g['dict'],{'x':6})
+			d3.close() # Copies do not close the file
+			self.assertEqual(d2['a0'].tolist(),list(range(1000)))
+			d2.close()
+			self.assertEqual(len(cache),0)
+			self.assertRaises(errors.BackendError,lambda: d2['a0'])
+			self.assertRaises(errors.BackendError,lambda: d3['a1'])
+			self.assertEqual(d4['a1'].tolist(),list(range(1000)))
+
+	def test_shards(self):
+		import os
+		self.d['top'] = 1
+		self.d.node('a/b',create=True)['x'] = np.arange(3)
+		self.d.node(2.5,create=True)['y'] = {'k':2}
+		self.d.node_attrs('a',{'note':'n'})
+		for backend in ['pytables','h5py']:
+			for processes in [None,2]:
+				shards = self.d.save_shards('output.hdf5',backend=backend,processes=processes)
+				self.assertEqual(len(shards),2)
+				self.assertTrue(all(os.path.exists(shard) for shard in shards))
+				for lazy in [False,True]:
+					d2 = Storage._load('output.hdf5',backend=backend,lazy=lazy)
+					self.assertEqual(d2['top'],1)
+					self.assertEqual(d2.node('a/b')['x'].tolist(),[0,1,2])
+					self.assertEqual(d2.node(2.5)['y'],{'k':2})
+					self.assertEqual(d2.node_attrs('a')['note'],'n')
+					d2.close()
+		self.assertRaises(errors.InvalidNodeError,self.d.save_shards,'output.hdf5',shards=['a','a/b'])
+		self.assertRaises(errors.InvalidNodeError,self.d.save_shards,'output.hdf5',shards=['top'])
+
+	def test_live(self):
+		self.d['a'] = np.arange(3)
+		self.d.node('g',create=True)['b'] = np.zeros((0,2))
+		self.d['dict'] = {'k':1}
+		self.d['flags'] = np.array([True,False])
+		self.d['scalar'] = 1
+		with self.d.save_live('output.hdf5') as writer:
+			d2 = Storage._load('output.hdf5',backend='h5py',lazy=True,swmr=True)
+			self.assertEqual(d2['a'].tolist(),[0,1,2])
+			writer.append('a',[3,4])
+			writer.append('g/b',[[1,2]])
+			self.assertEqual(d2['a'].tolist(),[0,1,2])
+			d2.refresh()
+			self.assertEqual(d2['a'].tolist(),[0,1,2,3,4])
+			self.assertEqual(d2.g['b'].tolist(),[[1,2]])
+			self.assertRaises(errors.InvalidNodeError,writer.append,'dict',[1])
+			self.assertRaises(errors.InvalidNodeError,writer.append,'scalar',[1])
+			writer.append('flags',[False,True,True])
+			d2.refresh()
+			self.assertEqual(d2['flags'].tolist(),[True,False,False,True,True])
+			d2.close()
+		d2 = Storage._load('output.hdf5',backend='h5py')
+		self.assertEqual(d2['a'].tolist(),[0,1,2,3,4])
+		self.assertEqual(d2['flags'].tolist(),[True,False,False,True,True])
+		self.assertEqual(d2['scalar'],1)
+		self.assertRaises(errors.BackendError,Storage._load,'output.hdf5',backend='pytables',swmr=True)
+
+	def test_compression(self):
+		import os
+		from hdf5storage.compression import CompressionPolicy
+		self.d['zeros'] = np.zeros((200,1000))
+		self.d['noise'] = np.random.random(100000)
+		self.d['flags'] = np.arange(100000) % 3 == 0
+		self.d['small'] = np.arange(10)
+		self.d.save('output.hdf5')
+		plain = os.path.getsize('output.hdf5')
+		for backend in ['pytables','h5py']:
+			for read in ['pytables','h5py']:
+				self.d.save('output.hdf5',backend=backend,compression='ratio')
+				self.assertTrue(os.path.getsize('output.hdf5') < plain*0.7)
+				d2 = Storage._load('output.hdf5',backend=read)
+				self.assertEqual(d2['zeros'].shape,(200,1000))
+				self.assertEqual(d2['noise'].tolist(),self.d['noise'].tolist())
+				self.assertEqual(d2['flags'].tolist(),self.d['flags'].tolist())
+				attrs = d2.node_attrs('zeros')
+				self.assertEqual(attrs['hdf5storage_compression'],'zlib')
+				self.assertEqual(attrs['hdf5storage_compression_chunks'].tolist(),[32,1000])
+				self.assertFalse('hdf5storage_compression_time' in attrs)
+				self.assertEqual(d2.node_attrs('small'),{'type':'data_array'})
+
+		self.d.node_attrs('zeros',{'compression':'mine'})
+		self.d.save('output.hdf5',compression=CompressionPolicy('speed',min_ratio=2,record_time=True))
+		d2 = Storage._load('output.hdf5')
+		self.assertEqual(d2.node_attrs('noise')['hdf5storage_compression'],'none')
+		self.assertEqual(d2.node_attrs('zeros')['hdf5storage_compression'],'zlib')
+		self.assertEqual(d2.node_attrs('zeros')['compression'],'mine')
+		self.assertTrue(d2.node_attrs('zeros')['hdf5storage_compression_time'] < 0.5)
+		d2.save('output2.hdf5')
+		self.assertEqual(Storage._load('output2.hdf5').node_attrs('noise'),{'type':'data_array'})
+		self.assertRaises(ValueError,CompressionPolicy,'size')
+
+	def test_blocks(self):
+		from hdf5storage import errors
+		self.d['x'] = np.arange(30000,dtype=float).reshape(-1,3)
+		self.d['flags'] = np.arange(1000) % 3 == 0
+		self.d['scalar'] = 1
+		self.d.map_blocks('x',lambda block: block.sum(axis=1),out='sums',block_bytes=1000,workers=3)
+		self.assertEqual(self.d['sums'].tolist(),self.d['x'].sum(axis=1).tolist())
+		self.assertEqual(self.d.reduce_blocks('x',np.sum,lambda a,b: a+b,block_bytes=1000),self.d['x'].sum())
+		self.assertRaises(ValueError,self.d.map_blocks,'x',np.sum,out='total')
+		self.assertRaises(errors.InvalidNodeError,self.d.map_blocks,'scalar',np.abs,out='y')
+		self.assertRaises(errors.NodeExistsError,self.d.map_blocks,'x',np.abs,out='sums')
+		self.d >> 'output.hdf5'
+
+		for backend in ['pytables','h5py']:
+			d2 = Storage._load('output.hdf5',backend=backend,lazy=True)
+			self.assertRaises(errors.BackendError,d2.map_blocks,'x',np.abs,out='y')
+			d2.close()
+
+			d2 = Storage._load('output.hdf5',backend=backend,lazy=True,mode='a')
+			d2.node('g',create=True)
+			d2.map_blocks('x',lambda block: block[:,:2]*2,out='x2_%s'%backend,block_bytes=1000,workers=2)
+			d2.map_blocks('flags',np.logical_not,out='not_flags_%s'%backend,block_bytes=100)
+			self.assertEqual(d2['x2_%s'%backend].tolist(),(self.d['x'][:,:2]*2).tolist())
+			self.assertEqual(d2.reduce_blocks('flags',np.sum,lambda a,b: a+b,block_bytes=100),334)
+			d2.node('new_%s'%backend,create=True).set_attrs(note='new')
+			d2.map_blocks('x',np.negative,out='new_%s/y'%backend,block_bytes=1000)
+			self.assertEqual(d2.node('new_%s'%backend)['y'].tolist(),(-self.d['x']).tolist())
+			
+			def fail(block):
+				if block[0,0] > 0:
+					raise RuntimeError
+				return block
+			for out in ['partial_%s'%backend,'g/h/partial_%s'%backend]:
+				d2.node(out.rsplit('/',1)[0] if '/' in out else '/',create=True)
+				self.assertRaises(RuntimeError,d2.map_blocks,'x',fail,out=out,block_bytes=1000,workers=1)
+				d2.map_blocks('x',np.abs,out=out,block_bytes=1000)
+				self.assertEqual(d2.node(out).value.tolist(),self.d['x'].tolist())
+			d2.close()
+
+			d3 = Storage._load('output.hdf5')
+			self.assertEqual(d3['not_flags_%s'%backend].tolist(),(~self.d['flags']).tolist())
+			self.assertEqual(d3.node_attrs('x2_%s'%backend),{'type':'data_array'})
+			self.assertEqual(d3.node_attrs('new_%s'%backend),{'type':'storage','note':'new'})
+			self.assertEqual(d3.node('g/h/partial_%s'%backend).value.tolist(),self.d['x'].tolist())
+
+	def test_digests(self):
+		from hdf5storage import diff, verify
+		from hdf5storage.digest import Difference
+		self.d['x'] = np.arange(100000.)
+		self.d['flags'] = np.arange(100) % 3 == 0
+		self.d['text'] = 'text'
+		self.d['labels'] = np.array([u'\xe9%d' % i for i in range(20000)])
+		self.d['table'] = {'a':1.0,'b':2.0}
+		self.d.node('g',create=True)['y'] = np.ones((20,30))
+		for backend in ['pytables','h5py']:
+			self.d.save('output.hdf5',backend=backend,digests='chunks',compression='ratio')
+			self.d.save('output2.hdf5',backend='h5py' if backend == 'pytables' else 'pytables',digests=True)
+			self.assertEqual(diff('output.hdf5','output2.hdf5'),[])
+			self.assertEqual(verify('output.hdf5'),[])
+			self.assertEqual(verify('output2.hdf5',backend=backend),[])
+
+		d2 = Storage._load('output.hdf5')
+		self.assertTrue(d2.node_attrs('x')['hdf5storage_digest'].startswith('sha256:'))
+		self.assertEqual(d2.node_attrs('table')['hdf5storage_digest'],Storage._load('output2.hdf5').node_attrs('table')['hdf5storage_digest'])
+		d2['x'][70000] = -1
+		d2.node('g').set_attrs(note='changed')
+		d2['extra'] = 1
+		d2.save('output2.hdf5',digests='chunks')
+		self.assertEqual(diff('output.hdf5','output2.hdf5'),[Difference('/extra','only in b'),Difference('/g','attrs'),Difference('/x','data',[(65536,98304)])])
+		d2.save('output2.hdf5')
+		self.assertEqual(Storage._load('output2.hdf5').node_attrs('x'),{'type':'data_array'})
+		self.assertEqual(diff('output2.hdf5','output.hdf5'),[Difference('/extra','only in a'),Difference('/g','attrs'),Difference('/x','data')])
+
+		import h5py
+		with h5py.File('output.hdf5','r+') as f:
+			f['x'][5] = -1
+		self.assertEqual(verify('output.hdf5'),[Difference('/x','corrupt',[(0,32768)])])
+		self.assertRaises(ValueError,self.d.save,'output.hdf5',digests='md4x')
+		
+		from hdf5storage import digest
+		self.d.node_attrs('x',{'digest':'mine'})
+		limit,digest.MAX_CHUNK_DIGEST_BYTES = digest.MAX_CHUNK_DIGEST_BYTES,128
+		try:
+			self.d.save('output.hdf5',digests=digest.DigestPolicy('sha512',chunks=True))
+		finally:
+			digest.MAX_CHUNK_DIGEST_BYTES = limit
+		attrs = Storage._load('output.hdf5').node_attrs('x')
+		self.assertEqual(attrs['digest'],'mine')
+		self.assertEqual(attrs['hdf5storage_digest_chunks'].shape,(2,64))
+		self.assertEqual(verify('output.hdf5'),[])
 
 	##### TEST ATTRIBUTES ##################################################
 	def test_attr(self):
 		self.d.set_attrs(cat='cat')
-		self.assertEquals(self.d.attrs['cat'],'cat')
+		self.assertEqual(self.d.attrs['cat'],'cat')
 		self.d.set_attrs(auto_nodes=True)
 		self.d.x['dim'] = [np.array([1,2,3]),np.array([1,23,4])]
 		self.d.node_attrs('x/dim/0',{'test':1,'test2':2})
-		self.assertEquals(self.d.node_attrs('x/dim/0'),{'test':1})
+		self.assertEqual(self.d.node_attrs('x/dim/0'),{'test':1})
 
 		self.d >> 'output.hdf5'
 		d2 = self.d._load('output.hdf5')
-		self.assertEquals(d2.node_attrs('x/dim/0'),{'test':1})
+		self.assertEqual(d2.node_attrs('x/dim/0'),{'test':1})
 	
 	def test_nested_attr(self):
 		self.d['test2'] = [np.array([1])]
@@ -63,8 +350,20 @@ class TestUnitNewCreation(unittest.TestCase):
 		
 		self.d >> 'output2.hdf5'
 		d2 = Storage._load('output2.hdf5')
-		self.assertEquals(d2.node_attrs('test2/0'),{'attr':1})
-	
+		self.assertEqual(d2.node_attrs('test2/0'),{'attr':1})
+
+	def test_compact_nodes(self):
+		self.d['test'] = [np.array([1]),np.array([2])]
+		self.assertFalse(hasattr(self.d.node('test/0'),'__dict__'))
+		self.assertFalse(hasattr(self.d,'__dict__'))
+
+		self.d.node_attrs('test/0',attrs={'attr':1})
+		self.assertEqual(self.d.node_attrs('test/0'),{'attr':1})
+		self.assertEqual(self.d.node_attrs('test/1'),{})
+		self.d.node_attrs('test/1')['attr'] = 2
+		self.assertEqual(self.d.node_attrs('test/1'),{'attr':2})
+		self.assertEqual(self.d.node('test/0').attrs,{'attr':1})
+
 	##### TEST DATA TYPES ##################################################
 	def test_dict(self):
 		self.d['test'] = {'dog': 3.2, 2.3: 1.5}
@@ -72,6 +371,43 @@ class TestUnitNewCreation(unittest.TestCase):
 		d2 = self.d._load('output.hdf5')
 		self.assertEqual(d2['test'],{'dog':3.2, 2.3: 1.5})
 	
+	def test_dict_typed(self):
+		self.d['ints'] = {'a':1, 'b'*50:2, 3:4}
+		self.d['complex'] = {1.5:1+2j}
+		self.d['strings'] = {'x':'short', 'y':'a rather longer string'}
+		self.d['arrays'] = {'x':np.arange(3), 'y':np.ones(3,dtype=int)}
+		self.d >> 'output.hdf5'
+		d2 = self.d._load('output.hdf5')
+		self.assertEqual(d2['ints'],{'a':1, 'b'*50:2, 3:4})
+		self.assertEqual(d2['complex'],{1.5:1+2j})
+		self.assertEqual(d2['strings'],{'x':'short', 'y':'a rather longer string'})
+		self.assertEqual(d2['arrays']['x'].tolist(),[0,1,2])
+		self.assertEqual(d2['arrays']['y'].tolist(),[1,1,1])
+	
+	def test_dict_keys(self):
+		self.d['brackets'] = {'f(x)':1.0, 'y':2.0}
+		self.d['encoded'] = {'float(1.0)':1, 'int(3)':2, 1.0:3, 3:4}
+		self.d['unicode'] = {u'a':1.0}
+		self.d >> 'output.hdf5'
+		d2 = self.d._load('output.hdf5')
+		self.assertEqual(d2['brackets'],{'f(x)':1.0, 'y':2.0})
+		self.assertEqual(d2['encoded'],{'float(1.0)':1, 'int(3)':2, 1.0:3, 3:4})
+		self.assertEqual(d2['unicode'],{'a':1.0})
+	
+	def test_dict_mixed(self):
+		for data in [{'a':'x', 'b':1}, {'a':np.arange(2), 'b':np.arange(3)}, {'a':np.arange(2), 'b':np.ones(3)}, {'a':1, 'b':2**70}, {'a':1.5, 'b':2**53+1}, {'a':1.5, 'b':1j}, {'a':True, 'b':1}]:
+			self.d['mixed'] = data
+			self.assertRaises(ValueError,self.d.save,'output.hdf5')
+		
+		self.d['numbers'] = {'n':3, 'mean':2.5, 'valid':True}
+		self.d['rows'] = {'a':np.arange(2), 'b':np.ones(2)}
+		self.d.pop('mixed')
+		self.d.save('output.hdf5')
+		d2 = Storage._load('output.hdf5')
+		self.assertEqual(d2['numbers'],{'n':3.0, 'mean':2.5, 'valid':1.0})
+		self.assertTrue(all(isinstance(value,float) for value in d2['numbers'].values()))
+		self.assertEqual(dict((key,value.tolist()) for key,value in d2['rows'].items()),{'a':[0.0,1.0], 'b':[1.0,1.0]})
+	
 	def test_array(self):
 		self.d['test'] = np.array([1,2,3])
 		self.d >> 'output.hdf5'
@@ -94,9 +430,72 @@ class TestUnitNewCreation(unittest.TestCase):
 		
 		self.d >> "test.mat"
 
+	def test_mat(self):
+		import scipy.io as spio
+		self.d['a'] = np.arange(6).reshape(2,3)
+		self.d['text'] = 'tet'
+		self.d.node('x/y',create=True)['b'] = 1.5
+		self.d.x['list'] = [1,2]
+		self.d[2.5] = 1
+		self.d >> 'output.mat'
+		m = spio.loadmat('output.mat')
+		self.assertEqual(m['a'].tolist(),[[0,1,2],[3,4,5]])
+		self.assertEqual(m['text'].tolist(),['tet'])
+		self.assertEqual(m['x']['y'][0,0]['b'][0,0].tolist(),[[1.5]])
+		self.assertEqual(m['x']['list'][0,0].shape,(1,2))
+		self.assertEqual(m['float_2_50000000000000000e_00_'].tolist(),[[1]])
+		
+		d = Storage('Mat')
+		d.node('x/y',create=True)['b'] = 1.5
+		d.node('empty',create=True)
+		d.save_mat('output.mat',do_compression=False)
+		m = spio.loadmat('output.mat')
+		self.assertEqual(m['x']['y'][0,0]['b'][0,0].tolist(),[[1.5]])
+		self.assertEqual(m['empty'].shape,(1,1))
+		
+		from hdf5storage import matlab
+		self.assertTrue(matlab.mat5Private() is not None)
+		versions = matlab.SCIPY_PRIVATE_VERSIONS
+		matlab.SCIPY_PRIVATE_VERSIONS = ((0,0),(0,0))
+		try:
+			self.assertTrue(matlab.mat5Private() is None)
+			for compression in [True,False]:
+				self.d.save_mat('output.mat',do_compression=compression)
+				m = spio.loadmat('output.mat')
+				self.assertEqual(m['a'].tolist(),[[0,1,2],[3,4,5]])
+				self.assertEqual(m['text'].tolist(),['tet'])
+				self.assertEqual(m['x']['y'][0,0]['b'][0,0].tolist(),[[1.5]])
+				self.assertEqual(m['x']['list'][0,0].shape,(1,2))
+		finally:
+			matlab.SCIPY_PRIVATE_VERSIONS = versions
+
+		import h5py
+		self.d.save_mat('output73.mat',version='7.3')
+		f = h5py.File('output73.mat','r')
+		self.assertEqual(f['a'][()].tolist(),[[0,3],[1,4],[2,5]])
+		self.assertEqual(f['a'].attrs['MATLAB_class'],b'int64')
+		self.assertEqual(f['x/y'].attrs['MATLAB_class'],b'struct')
+		self.assertEqual(f['x/y/b'][()].tolist(),[[1.5]])
+		self.assertEqual(f[f['x/list'][0,0]][()].tolist(),[[1]])
+		f.close()
+		self.assertEqual(open('output73.mat','rb').read(128)[-4:],b'\x00\x02IM')
+		
+		self.d[1] = 1
+		self.d['long_1_'] = 2
+		self.assertRaises(errors.InvalidNodeNameError,self.d.save_mat,'output.mat')
+		self.assertRaises(errors.InvalidNodeNameError,self.d.save_mat,'output73.mat',version='7.3')
+		self.d.pop(1)
+		self.d['dict'] = {'a b':1, 'a_b':2}
+		self.assertRaises(errors.InvalidNodeNameError,self.d.save_mat,'output.mat')
+
 	def test_warnings(self):
 		self.d.set_attrs(auto_nodes=True)
 		self.d.node('nodes',create=True)['test'] = 1
 
+	def test_lazy_imports(self):
+		import subprocess, sys
+		script = "import sys, hdf5storage; hdf5storage.Storage()['x'] = 1; print(' '.join(m for m in ('tables','h5py') if m in sys.modules))"
+		self.assertEqual(subprocess.check_output([sys.executable,'-c',script]).strip(),b'')
+
 if __name__ == '__main__':
     unittest.main()